@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# Offline benchmark of the dedup pipeline against a fake TelegramClient
+#   ./run.py bench/dedup.py -- --mps 200 --messages 2000 --dup-ratio .5
+import argparse
+import asyncio
+import io
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+from contextlib import redirect_stdout
+from pathlib import Path
+
+from telethon import types
+
+from bench.fake import FakeClient
+from massa_army_bot import bot
+from massa_army_bot.outbox import Outbox
+
+env = {
+    "TG_API_ID": "0",
+    "TG_API_HASH": "bench",
+    "TG_BOT_TOKEN": "bench",
+    "TG_BOT_USERNAME": "bench_bot",
+    "TG_LOG_CHANNEL": "-1000000000000",
+}
+
+def parse_args(argv):
+    p = argparse.ArgumentParser()
+    p.add_argument("--mps", type=float, default=200,
+                   help="incoming messages per second")
+    p.add_argument("--messages", type=int, default=2000,
+                   help="number of messages to send")
+    p.add_argument("--urls", type=int, default=3,
+                   help="twitter urls per message")
+    p.add_argument("--dup-ratio", type=float, default=.3,
+                   help="share of urls already posted in the chat")
+    p.add_argument("--chats", type=int, default=4)
+    p.add_argument("--topics", type=int, default=5,
+                   help="forum topics per chat, the first one raids")
+    p.add_argument("--raid-share", type=float, default=.8,
+                   help="share of messages posted in the raid topic")
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--rpc-latency", type=float, default=0.,
+                   help="simulated telegram round trip, in seconds")
+    p.add_argument("--throttle", action="store_true",
+                   help="keep the outbox rate limits")
+    p.add_argument("--workers", type=int, default=0,
+                   help="dedup worker processes, 0 dedups in-process")
+    p.add_argument("--record", type=Path,
+                   help="record the updates to this directory, "
+                   "for bench/replay.py")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("-v", "--verbose", action="store_true",
+                   help="show the bot's own output")
+    return p.parse_args(argv)
+
+def url_message(rng, args, posted):
+    entities = []
+    text = ""
+    for _ in range(args.urls):
+        if posted and rng.random() < args.dup_ratio:
+            tw_username, tw_post_id = rng.choice(posted)
+        else:
+            tw_username = "user%d" % rng.randrange(1000)
+            tw_post_id = rng.randrange(10**18, 2 * 10**18)
+            posted.append((tw_username, tw_post_id))
+        prefix = rng.choice(("", "go go go ", "raid this: "))
+        url = "https://x.com/%s/status/%d" % (tw_username, tw_post_id)
+        entities.append((len(text) + len(prefix), len(url)))
+        text += prefix + url + "\n"
+    return text.rstrip("\n"), entities
+
+def percentile(values, pct):
+    if len(values) < 2:
+        return values[0] if values else 0.
+    return statistics.quantiles(values, n=100)[pct - 1]
+
+async def run(bot, client, args):
+    rng = random.Random(args.seed)
+    hr = bot.hr
+    if not args.throttle:
+        unlimited = 10**9
+        hr.outbox = Outbox(global_rate=unlimited, private_rate=unlimited,
+                           group_rate=unlimited, private_burst=unlimited,
+                           group_burst=unlimited, max_running=unlimited)
+    await hr.start(init=bot.init_bot)
+    try:
+        await measure(bot, client, args, rng)
+    finally:
+        await hr.stop(fini=bot.fini_db)
+
+async def measure(bot, client, args, rng):
+    db_ops = Counter()
+    def trace(sql):
+        db_ops[sql.split(None, 1)[0].upper()] += 1
+    for conn in (bot.db.writer, *bot.db._readers):
+        await conn.set_trace_callback(trace)  # type: ignore
+    chats = []
+    for c in range(args.chats):
+        chat_id = client.add_channel(1000 + c, "Raid chat %d" % c)
+        topics = [client.add_topic(chat_id, "Topic %d" % t)
+                  for t in range(args.topics)]
+        await bot.db.execute(
+            "INSERT INTO raid_topics (topic_chat, topic_id) VALUES (?, ?)",
+            (chat_id, topics[0]))
+        bot.raid_topics[chat_id] = topics[0]
+        chats.append((chat_id, topics, []))
+    users = [client.add_user(10_000 + u, "Raider", str(u)).id
+             for u in range(args.users)]
+    messages = []
+    for _ in range(args.messages):
+        chat_id, topics, posted = rng.choice(chats)
+        topic = (topics[0] if rng.random() < args.raid_share
+                 else rng.choice(topics[1:] or topics))
+        text, spans = url_message(rng, args, posted)
+        messages.append(client.make_message(
+            chat_id, rng.choice(users), text, reply_to=topic,
+            entities=[types.MessageEntityUrl(offset, length)
+                      for offset, length in spans]))
+    rpcs_before = client.rpcs.copy()
+    db_ops.clear()
+    latencies = []
+    async def timed(msg):
+        start = time.perf_counter()
+        await client.dispatch(msg)
+        latencies.append(time.perf_counter() - start)
+    interval = 1 / args.mps
+    tasks = []
+    with redirect_stdout(sys.stdout if args.verbose else io.StringIO()):
+        start = time.perf_counter()
+        for i, msg in enumerate(messages):
+            delay = start + i * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(timed(msg)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+    rpcs = client.rpcs - rpcs_before
+    n = len(messages)
+    print("messages:        %d (%d urls each, %.0f%% duplicates)" % (
+        n, args.urls, args.dup_ratio * 100))
+    print("offered load:    %.1f msg/s" % args.mps)
+    print("throughput:      %.1f msg/s" % (n / elapsed))
+    print("latency p50:     %.2f ms" % (percentile(latencies, 50) * 1000))
+    print("latency p99:     %.2f ms" % (percentile(latencies, 99) * 1000))
+    print("db ops/msg:      %.2f (%s)" % (
+        db_ops.total() / n,
+        ", ".join("%s %.2f" % (k, v / n) for k, v in db_ops.most_common())))
+    print("rpcs/msg:        %.2f (%s)" % (
+        rpcs.total() / n,
+        ", ".join("%s %.2f" % (k, v / n) for k, v in rpcs.most_common())))
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    extra = {"DEDUP_WORKERS": str(args.workers)}
+    if args.record is not None:
+        extra["RECORD_UPDATES"] = str(args.record.resolve())
+    os.chdir(tempfile.mkdtemp(prefix="massa_army_bench_"))
+    client = FakeClient(rpc_latency=args.rpc_latency)
+    bot.create_app(env=env | extra, client=client)
+    asyncio.run(run(bot, client, args))
+
+if __name__ == "__main__":
+    main()
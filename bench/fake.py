@@ -0,0 +1,294 @@
+import asyncio
+import inspect
+import itertools
+from collections import Counter
+from datetime import datetime
+from datetime import timezone as tz
+from functools import wraps
+from types import SimpleNamespace
+
+from telethon import events
+from telethon import functions
+from telethon import types
+from telethon import utils
+from telethon.client.updates import EventBuilderDict
+
+html_mode = utils.sanitize_parse_mode("html")
+
+def rpc(func):
+    @wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        self.rpcs[func.__name__] += 1
+        return await self._call(None, func(self, *args, **kwargs))
+    return wrapper
+
+class FakeClient:
+    # in-process stand-in for the parts of TelegramClient the bot uses
+    def __init__(self, session=None, api_id=None, api_hash=None, *,
+                 me_id=1, me_username="fake_bot", rpc_latency=0.,
+                 **kwargs):
+        self.session = session
+        self.rpc_latency = rpc_latency
+        self.rpcs = Counter()
+        self.me = types.User(id=me_id, is_self=True, bot=True,
+                             bot_info_version=0,
+                             access_hash=0, first_name=me_username,
+                             username=me_username)
+        self._self_id = me_id
+        self._mb_entity_cache = {}
+        self._event_builders = []
+        self._loop = None
+        self.entities: dict[int, object] = {me_id: self.me}
+        self.messages: dict[tuple[int, int], types.Message] = {}
+        self.topics: dict[int, dict[int, str]] = {}
+        self.admins: set[tuple[int, int]] = set()
+        self._msg_ids: dict[int, itertools.count] = {}
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            try:
+                self._loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self._loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(self._loop)
+        return self._loop
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        ...
+
+    async def start(self, *args, **kwargs):
+        return self
+
+    def is_connected(self):
+        return True
+
+    async def disconnect(self):
+        ...
+
+    def run_until_disconnected(self):
+        ...
+
+    def on(self, event):
+        def decorator(f):
+            self.add_event_handler(f, event)
+            return f
+        return decorator
+
+    def add_event_handler(self, callback, event=None):
+        if isinstance(event, type):
+            event = event()
+        elif event is None:
+            event = events.Raw()
+        self._event_builders.append((event, callback))
+
+    # world building
+
+    def add_user(self, user_id, first_name, last_name=None, username=None):
+        user = types.User(id=user_id, access_hash=0, first_name=first_name,
+                          last_name=last_name, username=username)
+        self.entities[user_id] = user
+        return user
+
+    def add_channel(self, channel_id, title, forum=True, username=None):
+        channel = types.Channel(id=channel_id, title=title,
+                                photo=types.ChatPhotoEmpty(),
+                                date=datetime.now(tz=tz.utc),
+                                megagroup=True, forum=forum,
+                                access_hash=0, username=username)
+        chat_id = utils.get_peer_id(channel)
+        self.entities[chat_id] = channel
+        if forum:
+            self.topics[chat_id] = {1: "General"}
+        return chat_id
+
+    def add_topic(self, chat_id, title):
+        action = types.MessageActionTopicCreate(title=title, icon_color=0)
+        msg = self._store(types.MessageService(
+            id=self._next_id(chat_id), peer_id=utils.get_peer(chat_id),
+            date=datetime.now(tz=tz.utc), from_id=types.PeerUser(self.me.id),
+            action=action))
+        self.topics[chat_id][msg.id] = title
+        return msg.id
+
+    def _next_id(self, chat_id):
+        if chat_id not in self._msg_ids:
+            self._msg_ids[chat_id] = itertools.count(2)
+        return next(self._msg_ids[chat_id])
+
+    def _store(self, msg):
+        msg._finish_init(self, self.entities, None)
+        self.messages[(utils.get_peer_id(msg.peer_id), msg.id)] = msg
+        return msg
+
+    def _reply_header(self, chat_id, reply_to):
+        if reply_to is None:
+            return None
+        if chat_id not in self.topics:
+            return types.MessageReplyHeader(reply_to_msg_id=reply_to)
+        if reply_to in self.topics[chat_id]:
+            return types.MessageReplyHeader(reply_to_msg_id=reply_to,
+                                            forum_topic=True)
+        parent = self.messages.get((chat_id, reply_to))
+        header = parent and parent.reply_to
+        if not header or not header.forum_topic:  # type: ignore
+            return types.MessageReplyHeader(reply_to_msg_id=reply_to)
+        top_id = (header.reply_to_top_id  # type: ignore
+                  or header.reply_to_msg_id)  # type: ignore
+        return types.MessageReplyHeader(reply_to_msg_id=reply_to,
+                                        reply_to_top_id=top_id,
+                                        forum_topic=True)
+
+    def make_message(self, chat_id, sender_id, text, html=False,
+                     entities=None, reply_to=None, out=False, date=None):
+        if html:
+            text, entities = html_mode.parse(text)  # type: ignore
+        return self._store(types.Message(
+            id=self._next_id(chat_id), peer_id=utils.get_peer(chat_id),
+            date=date or datetime.now(tz=tz.utc), message=text, out=out,
+            from_id=types.PeerUser(sender_id), entities=entities,
+            reply_to=self._reply_header(chat_id, reply_to)))
+
+    # update dispatching, mirrors TelegramClient._dispatch_update
+
+    async def dispatch(self, update):
+        if isinstance(update, types.Message):
+            if isinstance(update.peer_id, types.PeerChannel):
+                update = types.UpdateNewChannelMessage(update, 0, 0)
+            else:
+                update = types.UpdateNewMessage(update, 0, 0)
+        update._entities = self.entities
+        await self._dispatch_update(update)
+
+    async def _dispatch_update(self, update):
+        built = EventBuilderDict(self, update, None)
+        for builder, callback in self._event_builders:
+            event = built[type(builder)]
+            if not event:
+                continue
+            if not builder.resolved:
+                await builder.resolve(self)
+            ok = builder.filter(event)
+            if inspect.isawaitable(ok):
+                ok = await ok
+            if not ok:
+                continue
+            try:
+                await callback(event)
+            except events.StopPropagation:
+                break
+
+    # rpcs
+
+    async def __call__(self, request):
+        self.rpcs[type(request).__name__] += 1
+        return await self._call(None, self._invoke(request))
+
+    async def _call(self, sender, request, ordered=False,
+                    flood_sleep_threshold=None):
+        # every rpc goes through here, as in TelegramClient
+        if self.rpc_latency:
+            await asyncio.sleep(self.rpc_latency)
+        return await request
+
+    async def _invoke(self, request):
+        if isinstance(request, functions.channels.GetForumTopicsRequest):
+            chat_id = utils.get_peer_id(request.channel)
+            topics = [(topic_id, title) for topic_id, title
+                      in sorted(self.topics.get(chat_id, {}).items(),
+                                reverse=True)
+                      if not request.offset_topic
+                      or topic_id < request.offset_topic]
+            now = datetime.now(tz=tz.utc)
+            return types.messages.ForumTopics(
+                count=len(topics),
+                topics=[types.ForumTopic(
+                    id=topic_id, date=now, title=title, icon_color=0,
+                    top_message=topic_id, read_inbox_max_id=0,
+                    read_outbox_max_id=0, unread_count=0,
+                    unread_mentions_count=0, unread_reactions_count=0,
+                    from_id=types.PeerUser(self.me.id),
+                    notify_settings=types.PeerNotifySettings())
+                    for topic_id, title in topics[:request.limit]],
+                messages=[], chats=[], users=[], pts=0)
+        raise NotImplementedError(type(request).__name__)
+
+    @rpc
+    async def get_me(self, input_peer=False):
+        return utils.get_input_peer(self.me) if input_peer else self.me
+
+    @rpc
+    async def catch_up(self):
+        ...
+
+    @rpc
+    async def get_entity(self, entity):
+        if isinstance(entity, str):
+            username = entity.rpartition("/")[2].lstrip("@").lower()
+            for value in self.entities.values():
+                if (getattr(value, "username", None) or "").lower() == username:
+                    return value
+            raise ValueError("No user has %r as username" % entity)
+        return self.entities[utils.get_peer_id(entity)]
+
+    async def get_input_entity(self, entity):
+        return utils.get_input_peer(await self.get_entity(entity))
+
+    @rpc
+    async def get_permissions(self, entity, user=None):
+        chat_id = utils.get_peer_id(entity)
+        user_id = utils.get_peer_id(user) if user is not None else None
+        admin = (chat_id, user_id) in self.admins
+        return SimpleNamespace(is_admin=admin, change_info=admin,
+                               is_creator=False, is_banned=False,
+                               has_left=False, has_default_permissions=True,
+                               post_messages=admin, edit_messages=admin,
+                               delete_messages=admin, ban_users=admin,
+                               invite_users=admin, pin_messages=admin,
+                               add_admins=False, manage_call=admin,
+                               anonymous=False, manage_topics=admin)
+
+    @rpc
+    async def get_messages(self, entity, ids=None, **kwargs):
+        chat_id = utils.get_peer_id(entity)
+        if isinstance(ids, types.InputMessageReplyTo):
+            msg = self.messages.get((chat_id, ids.id))
+            if msg is None or msg.reply_to is None:
+                return None
+            ids = msg.reply_to.reply_to_msg_id  # type: ignore
+        if isinstance(ids, (list, tuple)):
+            return [self.messages.get((chat_id, i)) for i in ids]
+        return self.messages.get((chat_id, ids))
+
+    @rpc
+    async def send_message(self, entity, message="", *, reply_to=None,
+                           parse_mode=(), file=None, **kwargs):
+        chat_id = utils.get_peer_id(entity)
+        if isinstance(reply_to, types.Message):
+            reply_to = reply_to.id
+        return self.make_message(chat_id, self.me.id, message,
+                                 html=parse_mode == "html",
+                                 reply_to=reply_to, out=True)
+
+    @rpc
+    async def edit_message(self, entity, message=None, text=None, *,
+                           parse_mode=(), **kwargs):
+        chat_id = utils.get_peer_id(entity)
+        msg_id = getattr(message, "id", message)
+        msg = self.messages[(chat_id, msg_id)]
+        if parse_mode == "html":
+            msg.message, msg.entities = html_mode.parse(  # type: ignore
+                text)
+        else:
+            msg.message, msg.entities = text, None
+        return msg
+
+    @rpc
+    async def delete_messages(self, entity, message_ids, **kwargs):
+        chat_id = utils.get_peer_id(entity)
+        if isinstance(message_ids, int):
+            message_ids = [message_ids]
+        return [self.messages.pop((chat_id, i), None) for i in message_ids]
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# Micro-benchmark of twitter status link extraction: html rendering plus
+# regex against a single pass over the message entities
+#   ./run.py bench/links.py -- --number 20000
+import argparse
+import random
+import sys
+import timeit
+
+from telethon import types
+
+from massa_army_bot import bot
+from massa_army_bot.dedup import twitter_url_pattern
+from massa_army_bot.links import extract_links
+
+def parse_args(argv):
+    p = argparse.ArgumentParser()
+    p.add_argument("--number", type=int, default=20000,
+                   help="extractions per message kind")
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--seed", type=int, default=0)
+    return p.parse_args(argv)
+
+def status_url(rng):
+    return "https://x.com/user%d/status/%d" % (
+        rng.randrange(1000), rng.randrange(10**18, 2 * 10**18))
+
+def message(text, entities):
+    return types.Message(id=1, peer_id=types.PeerChannel(1), date=None,
+                         message=text, entities=entities)
+
+def plain(rng):
+    return message("gm raiders 🔥 who is up for the next one?", [])
+
+def formatted(rng):
+    text = "gm raiders 🔥 who is up for the next one?"
+    return message(text, [types.MessageEntityBold(0, 10),
+                          types.MessageEntityItalic(14, 6)])
+
+def status_links(count):
+    def make(rng):
+        text, entities = "", []
+        for _ in range(count):
+            prefix = rng.choice(("", "go go go 🚀 ", "raid this: "))
+            url = status_url(rng)
+            offset = len(text.encode("utf-16-le")) // 2 + len(
+                prefix.encode("utf-16-le")) // 2
+            entities.append(types.MessageEntityUrl(offset, len(url)))
+            text += prefix + url + "\n"
+        return message(text.rstrip("\n"), entities)
+    return make
+
+def text_urls(rng):
+    text = "raid this one and that one 💪"
+    return message(text, [
+        types.MessageEntityTextUrl(0, 13, status_url(rng)),
+        types.MessageEntityBold(14, 12),
+        types.MessageEntityTextUrl(18, 8, status_url(rng))])
+
+kinds = {
+    "plain": plain,
+    "formatted": formatted,
+    "1 status link": status_links(1),
+    "3 status links": status_links(3),
+    "5 status links": status_links(5),
+    "text urls": text_urls,
+}
+
+def html_regex(msg):
+    return [m for m in twitter_url_pattern.finditer(
+        bot.to_html(msg))]
+
+def entities(msg):
+    return extract_links(msg.raw_text, msg.entities)
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    rng = random.Random(args.seed)
+    print("%-16s %12s %12s %8s" % ("message", "html+regex", "entities",
+                                   "speedup"))
+    for name, make in kinds.items():
+        msg = make(rng)
+        assert len(html_regex(msg)) == len(entities(msg)), name
+        timings = []
+        for func in (html_regex, entities):
+            best = min(timeit.repeat(lambda: func(msg),
+                                     number=args.number,
+                                     repeat=args.repeat))
+            timings.append(best / args.number * 1e6)
+        print("%-16s %10.2fus %10.2fus %7.1fx" % (
+            name, *timings, timings[0] / timings[1]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# Replays updates recorded with RECORD_UPDATES through the real handlers
+# against a fake TelegramClient
+#   ./run.py bench/replay.py -- data/updates --db data/twitter_posts.sqlite3
+import argparse
+import asyncio
+import cProfile
+import io
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from pathlib import Path
+
+from telethon import types
+from telethon import utils
+
+from bench.fake import FakeClient
+from massa_army_bot import bot
+from massa_army_bot.outbox import Outbox
+from massa_army_bot.recorder import ENTITY
+from massa_army_bot.recorder import read_log
+
+def parse_args(argv):
+    p = argparse.ArgumentParser()
+    p.add_argument("logs", nargs="+", type=Path,
+                   help="log files, or directories of them")
+    p.add_argument("--db", type=Path,
+                   help="database to start from, e.g. the bot's own")
+    p.add_argument("--username", default="bench_bot",
+                   help="the recording bot's username, for its commands")
+    p.add_argument("--speed", type=float, default=0.,
+                   help="pace relative to the recording, 0 is unpaced")
+    p.add_argument("--rpc-latency", type=float, default=0.,
+                   help="simulated telegram round trip, in seconds")
+    p.add_argument("--throttle", action="store_true",
+                   help="keep the outbox rate limits")
+    p.add_argument("--profile", type=Path,
+                   help="write the replay's cProfile stats to this file")
+    p.add_argument("-v", "--verbose", action="store_true",
+                   help="show the bot's own output")
+    return p.parse_args(argv)
+
+def log_files(paths):
+    for path in paths:
+        if path.is_dir():
+            yield from sorted(path.glob("updates-*.log"))
+        else:
+            yield path
+
+def load(client, paths):
+    updates = []
+    for path in log_files(paths):
+        for kind, at, obj in read_log(path):
+            if kind != ENTITY:
+                updates.append((at, obj))
+                continue
+            chat_id = utils.get_peer_id(obj)
+            client.entities[chat_id] = obj
+            if getattr(obj, "forum", False):
+                client.topics.setdefault(chat_id, {1: "General"})
+    return updates
+
+def percentile(values, pct):
+    if len(values) < 2:
+        return values[0] if values else 0.
+    return statistics.quantiles(values, n=100)[pct - 1]
+
+async def run(bot, client, args, updates):
+    hr = bot.hr
+    if not args.throttle:
+        unlimited = 10**9
+        hr.outbox = Outbox(global_rate=unlimited, private_rate=unlimited,
+                           group_rate=unlimited, private_burst=unlimited,
+                           group_burst=unlimited, max_running=unlimited)
+    await hr.start(init=bot.init_bot)
+    try:
+        await replay(bot, client, args, updates)
+    finally:
+        await hr.stop(fini=bot.fini_db)
+
+async def replay(bot, client, args, updates):
+    latencies = []
+    async def timed(update):
+        msg = getattr(update, "message", None)
+        if isinstance(msg, types.Message):
+            # for replies and topics to be looked up
+            client._store(msg)
+        start = time.perf_counter()
+        await client.dispatch(update)
+        latencies.append(time.perf_counter() - start)
+    rpcs_before = client.rpcs.copy()
+    bot.hr.metrics.reset()
+    profile = cProfile.Profile() if args.profile else None
+    first = updates[0][0] if updates else 0.
+    tasks = []
+    with redirect_stdout(sys.stdout if args.verbose else io.StringIO()):
+        if profile is not None:
+            profile.enable()
+        start = time.perf_counter()
+        for at, update in updates:
+            delay = (start + (at - first) / args.speed - time.perf_counter()
+                     if args.speed else 0)
+            await asyncio.sleep(max(delay, 0))
+            tasks.append(asyncio.create_task(timed(update)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+        if profile is not None:
+            profile.disable()
+    if profile is not None:
+        profile.dump_stats(args.profile)
+    rpcs = client.rpcs - rpcs_before
+    n = len(updates)
+    span = updates[-1][0] - first if updates else 0.
+    print("updates:         %d over %.1fs recorded" % (n, span))
+    print("replayed in:     %.1fs (%s)" % (
+        elapsed, "%gx speed" % args.speed if args.speed else "unpaced"))
+    print("throughput:      %.1f updates/s" % (n / elapsed if elapsed else 0))
+    print("latency p50:     %.2f ms" % (percentile(latencies, 50) * 1000))
+    print("latency p99:     %.2f ms" % (percentile(latencies, 99) * 1000))
+    print("rpcs/update:     %.2f (%s)" % (
+        rpcs.total() / n if n else 0,
+        ", ".join("%s %.2f" % (k, v / n) for k, v in rpcs.most_common())))
+    print(bot.hr.metrics.format())
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    # paths are given relative to where we were started
+    args.logs = [path.resolve() for path in args.logs]
+    if args.profile is not None:
+        args.profile = args.profile.resolve()
+    db = args.db.resolve() if args.db is not None else None
+    os.chdir(tempfile.mkdtemp(prefix="massa_army_replay_"))
+    if db is not None:
+        # the backup api copies a live database, wal included
+        bot.dbfile.parent.mkdir(parents=True, exist_ok=True)
+        with sqlite3.connect(db) as src, sqlite3.connect(bot.dbfile) as dst:
+            src.backup(dst)
+    client = FakeClient(rpc_latency=args.rpc_latency)
+    updates = load(client, args.logs)
+    bot.create_app(env={
+        "TG_API_ID": "0",
+        "TG_API_HASH": "replay",
+        "TG_BOT_TOKEN": "replay",
+        "TG_BOT_USERNAME": args.username,
+        "TG_LOG_CHANNEL": "-1000000000000",
+    }, client=client)
+    asyncio.run(run(bot, client, args, updates))
+
+if __name__ == "__main__":
+    main()
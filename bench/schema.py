@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# Size and lookup speed of tw_posts before and after the compact schema,
+# and with the raid stats triggers of the current one
+#   ./run.py bench/schema.py -- --posts 200000 --chats 20
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from massa_army_bot import db
+from massa_army_bot.migrations import compact_tw_posts
+from massa_army_bot.migrations import migrations
+
+old_insert_sql = (
+    "INSERT INTO tw_posts VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT DO NOTHING")
+old_select_sql = (
+    "SELECT * FROM tw_posts "
+    "WHERE tw_username = ? AND tw_post_id = ? AND tg_msg_chat = ?")
+
+def parse_args(argv):
+    p = argparse.ArgumentParser()
+    p.add_argument("--posts", type=int, default=200000)
+    p.add_argument("--chats", type=int, default=20)
+    p.add_argument("--users", type=int, default=5000,
+                   help="distinct twitter usernames")
+    p.add_argument("--lookups", type=int, default=50000)
+    p.add_argument("--hit-ratio", type=float, default=.3,
+                   help="share of lookups for posts already stored")
+    p.add_argument("--seed", type=int, default=0)
+    return p.parse_args(argv)
+
+def make_rows(rng, args):
+    chats = [-1000000000000 - c for c in range(args.chats)]
+    users = ["raider_account_%d" % u for u in range(args.users)]
+    rows = []
+    for i in range(args.posts):
+        chat = rng.choice(chats)
+        msg_id = 1000 + i
+        rows.append((rng.choice(users), rng.randrange(10**18, 2 * 10**18),
+                     rng.randrange(10**9), 1700000000 + i, chat, msg_id,
+                     2, db.message_url(chat, msg_id)))
+    return rows
+
+def make_lookups(rng, args, rows):
+    lookups = []
+    for _ in range(args.lookups):
+        if rng.random() < args.hit_ratio:
+            lookups.append(rng.choice(rows))
+        else:
+            row = rng.choice(rows)
+            lookups.append((row[0], rng.randrange(10**18, 2 * 10**18),
+                            *row[2:]))
+    return lookups
+
+def build(path, statements, insert):
+    conn = sqlite3.connect(path)
+    for sql in statements:
+        conn.execute(sql)
+    start = time.perf_counter()
+    insert(conn)
+    conn.commit()
+    elapsed = time.perf_counter() - start
+    conn.execute("VACUUM")
+    return conn, elapsed
+
+def size(conn):
+    page_count, = conn.execute("PRAGMA page_count").fetchone()
+    page_size, = conn.execute("PRAGMA page_size").fetchone()
+    return page_count * page_size
+
+def timed_lookups(conn, sql, params):
+    start = time.perf_counter()
+    for p in params:
+        conn.execute(sql, p).fetchone()
+    return time.perf_counter() - start
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    rng = random.Random(args.seed)
+    os.chdir(tempfile.mkdtemp(prefix="massa_army_bench_"))
+    rows = make_rows(rng, args)
+    lookups = make_lookups(rng, args, rows)
+
+    def insert_old(conn):
+        conn.executemany(old_insert_sql, rows)
+    old, old_insert = build("old.sqlite3", migrations[0], insert_old)
+    old_lookup = timed_lookups(old, old_select_sql, [
+        (tw_username, tw_post_id, tg_msg_chat)
+        for tw_username, tw_post_id, _, _, tg_msg_chat, *_ in lookups])
+
+    def insert_new(conn):
+        conn.executemany(db.insert_tw_user_sql,
+                         [(tw_username,) for tw_username
+                          in {row[0] for row in rows}])
+        conn.executemany(db.insert_tw_post_sql, map(db.post_params, rows))
+    def build_new(path, schema):
+        # the checks are for the rows being migrated, there are none
+        conn, insert = build(path, [sql for migration in schema
+                                    for sql in migration
+                                    if isinstance(sql, str)], insert_new)
+        lookup = timed_lookups(conn, db.select_tw_post_sql, [
+            (tg_msg_chat, tw_post_id)
+            for _, tw_post_id, _, _, tg_msg_chat, *_ in lookups])
+        return conn, insert, lookup
+    new, new_insert, new_lookup = build_new(
+        "new.sqlite3", migrations[:migrations.index(compact_tw_posts) + 1])
+    cur, cur_insert, cur_lookup = build_new("current.sqlite3", migrations)
+
+    n = len(rows)
+    print("posts:    %d in %d chats, %d usernames" % (
+        n, args.chats, args.users))
+    print("%-9s %12s %12s %14s" % ("schema", "size", "insert", "lookup"))
+    for name, conn, insert, lookup in (
+            ("rowid", old, old_insert, old_lookup),
+            ("compact", new, new_insert, new_lookup),
+            ("current", cur, cur_insert, cur_lookup)):
+        print("%-9s %9.1f MiB %9.2f us %11.2f us" % (
+            name, size(conn) / 2**20, insert / n * 1e6,
+            lookup / len(lookups) * 1e6))
+    print("size:     %.0f%% smaller" % (100 * (1 - size(new) / size(old))))
+    print("lookups:  %.2fx faster" % (old_lookup / new_lookup))
+    print("inserts:  %.2fx the time, %.2fx with the stats triggers" % (
+        new_insert / old_insert, cur_insert / old_insert))
+
+if __name__ == "__main__":
+    main()
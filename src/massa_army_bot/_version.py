@@ -0,0 +1 @@
+__version__="0"; __version_tuple__=(0,)
@@ -1,26 +1,60 @@
 import asyncio
+import inspect
 import logging
 import os
 import re
 import textwrap as tw
+import time
 from datetime import datetime
 from datetime import timezone as tz
 from functools import partial
 from functools import wraps
 from html import escape
+from operator import itemgetter
 from pathlib import Path
 from pprint import pformat
 from traceback import format_exc
 
-import aiosqlite
 from telethon import events
 from telethon import errors
+from telethon import functions
 from telethon import TelegramClient
 from telethon import types
 from telethon import utils
 from telethon.sessions.sqlite import sqlite3
 from telethon.tl.custom.message import Message
 
+from . import cache
+from . import metrics
+from .cache import missing
+from .cache import TTLCache
+from .db import Database
+from .db import message_url
+from .db import msg_url_template
+from .db import TwPostsIndex
+from .db import TwPostsWriter
+from .dedup import item_html
+from .dedup import link_template
+from .dedup import parse_mode
+from .dedup import plan_dedup
+from .dedup import unparse
+from .dedup import WorkItem
+from .dispatch import Dispatcher
+from .links import extract_links
+from .logsink import LogSink
+from .maintenance import Maintenance
+from .metrics import Metrics
+from .migrations import migrate
+from .notices import Notices
+from .outbox import LOG
+from .outbox import NOTICE
+from .outbox import Outbox
+from .outbox import REPOST
+from .recorder import Recorder
+from .scheduler import DeletionScheduler
+from .session import WriteBehindSession
+from .workers import Workers
+
 logging.basicConfig(format='[%(levelname) 5s/%(asctime)s] %(name)s: %(message)s',
                     level=logging.WARNING)
 
@@ -28,13 +62,23 @@ Event = events.NewMessage.Event
 
 datadir = Path("data")
 sessions = datadir / "sessions"
-sessions.mkdir(exist_ok=True, parents=True)
 
 dbfile = datadir / "twitter_posts.sqlite3"
+db = Database(dbfile)
+tw_posts = TwPostsIndex(db, TwPostsWriter(db))
+deletions = DeletionScheduler(db)
+archivefile = datadir / "twitter_posts_archive.sqlite3"
+maintenance = Maintenance(db, tw_posts, archivefile)
+# dedup runs in-process unless given workers
+workers = Workers(dbfile)
+# the workers index their shards, pruned posts are dropped from them too
+maintenance.on_prune.append(workers.forget)
 
 pf = partial(pformat, sort_dicts=False, width=35)
 
 sleep_time = 10
+# duplicates posted within half of it of each other share a notice
+notices = Notices(window=sleep_time // 2, delay=sleep_time)
 
 def event2dict(obj):
     if isinstance(obj, dict):
@@ -48,42 +92,137 @@ def event2dict(obj):
 class HalfRed:
     tg: TelegramClient
 
-    def __init__(self, username, api_id, api_hash, bot_token,
-                 log_channel,
-                 **clientparams) -> None:
+    def __init__(self) -> None:
+        # handlers can be registered before the client exists,
+        # nothing touches the network until configure() and start()
+        self.tg = None  # type: ignore
+        self.username = None
+        self.me: types.User | None = None
+        self.commands = {}
+        self.handlers = []
+        self.outbox = Outbox()
+        self.connected = asyncio.Event()
+        self.metrics = Metrics()
+        self.dispatcher = Dispatcher()
+        # more lines for the metrics summary
+        self.reporters = []
+        self.metrics_interval = 15 * 60
+        self._metrics_task = None
+        self.recorder = None
+        # rendered names of chats and senders, by peer id and options,
+        # grouped by peer id to drop a peer's names on a rename
+        self.names = TTLCache(maxsize=16384, ttl=60 * 60, name="names",
+                              group=itemgetter(0))
+
+    def configure(self, username, api_id, api_hash, bot_token,
+                  log_channel, client=None, metrics_interval=None,
+                  max_running=None, shed_depth=None, record_dir=None,
+                  **clientparams):
         self.username = username
-        self.tg = TelegramClient(sessions / username, api_id=api_id,
-                                 api_hash=api_hash,
-                                 **clientparams)
-        self.tg.start(bot_token=bot_token)
+        if metrics_interval is not None:
+            self.metrics_interval = float(metrics_interval)
+        if max_running is not None:
+            self.dispatcher.max_running = int(max_running)
+        if shed_depth is not None:
+            self.dispatcher.shed_depth = int(shed_depth)
+        self.bot_token = bot_token
+        if client is None:
+            sessions.mkdir(exist_ok=True, parents=True)
+            session = WriteBehindSession(sessions / username)
+            self.reporters.append(session.format)
+            client = TelegramClient(session, api_id=api_id,
+                                    api_hash=api_hash,
+                                    **clientparams)
+        # every rpc of TelegramClient goes through _call, those to other
+        # dcs too, where __call__ only sees the main one. it is private:
+        # requirements.txt pins the telethon it was checked against, and
+        # another one that dropped it fails here rather than untimed
+        call = getattr(client, "_call", None)
+        if not inspect.iscoroutinefunction(call):
+            raise RuntimeError(
+                "%s has no async _call to time rpcs with, "
+                "see the Telethon pin in requirements.txt"
+                % type(client).__name__)
+        async def _call(*args, **kwargs):
+            with metrics.waiting("rpc"):
+                return await call(*args, **kwargs)
+        client._call = _call
+        if record_dir:
+            # a raw handler sees every update, handled or not, ahead of
+            # the handlers registered after it
+            self.recorder = Recorder(Path(record_dir))
+            self.reporters.append(self.recorder.format)
+            async def record(update):
+                self.recorder.record(update)  # type: ignore
+            client.add_event_handler(record, events.Raw)
+        self.tg = client
         try:
             self.log_channel = int(log_channel)
         except ValueError:
             self.log_channel = log_channel
-        self.commands = {}
-        me = self.tg.loop.run_until_complete(
-            self.tg.get_me())
-        assert me
+        self.logs = LogSink(partial(self.send, self.log_channel,
+                                    priority=LOG, parse_mode="html"))
+        for handler in self.handlers:
+            self._register(*handler)
+        return self
+
+    async def _connect(self):
+        await self.tg.start(bot_token=self.bot_token)  # type: ignore
+        me = await self.tg.get_me()
+        assert isinstance(me, types.User)
         self.me = me
+        self.connected.set()
 
-    async def startup(self, init=None, *init_args, **init_kwargs):
-        username = self.me.username
-        if init is not None:
-            await init(*init_args, **init_kwargs)
+    async def start(self, init=None, *init_args, **init_kwargs):
+        self.outbox.start()
+        self.logs.start()
+        if self.metrics_interval:
+            self._metrics_task = asyncio.create_task(self._report_metrics())
+        # the db and its caches don't need telegram, warm them meanwhile
+        await asyncio.gather(
+            self._connect(),
+            *([init(*init_args, **init_kwargs)] if init is not None else []))
         await self.tg.catch_up()
         await self.log(
-            "Connected as @%s" % username)
+            "Connected as @%s" % self.me.username)  # type: ignore
 
-    async def log(self, text, file=None, *args, **kwargs):
+    async def log(self, text, file=None, **kwargs):
         fdate = datetime.now(tz=tz.utc).ctime()
         text = "%s\n%s" % (fdate, text)
         if file:
             text = "%s\nfile:%s" % (text, file)
         print(text)
-        return await self.tg.send_message(
-            self.log_channel, text,
-            file=file,  # type: ignore
-            parse_mode="html", *args, **kwargs)
+        self.logs.put(text, file=file, **kwargs)
+
+    async def _report_metrics(self):
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            if self.metrics.handlers:
+                await self.log("<pre>%s</pre>" % escape(
+                    self.format_metrics()))
+            self.metrics.reset()
+
+    def format_metrics(self):
+        return "\n".join((self.metrics.format(), self.dispatcher.format(),
+                          *(report() for report in self.reporters)))
+
+    async def send(self, chat_id, *args, priority=NOTICE, **kwargs):
+        # the rpc itself runs in the outbox, time the wait for it here
+        with metrics.waiting("rpc"):
+            return await self.outbox.send(chat_id, self.tg.send_message,
+                                          chat_id, *args,
+                                          priority=priority, **kwargs)
+
+    async def edit(self, chat_id, *args, priority=NOTICE, **kwargs):
+        with metrics.waiting("rpc"):
+            return await self.outbox.send(chat_id, self.tg.edit_message,
+                                          chat_id, *args,
+                                          priority=priority, **kwargs)
+
+    async def reply(self, event, *args, priority=NOTICE, **kwargs):
+        with metrics.waiting("rpc"):
+            return await self.outbox.send(event.chat_id, event.reply, *args,
+                                          priority=priority, **kwargs)
 
     @staticmethod
     def displayname(chat, showid=False, username=False, clickable=False):
@@ -111,47 +250,112 @@ class HalfRed:
             print(f"Error {e}:\n{format_exc()}")
             return f"<code>{chat.id}</code>"
 
+    async def _render_name(self, get_entity, **kwargs):
+        return self.displayname(await get_entity(), clickable=True, **kwargs)
+
+    async def render_name(self, peer_id, get_entity, **kwargs):
+        # get_entity is only awaited on a miss
+        if peer_id is None:
+            return await self._render_name(get_entity, **kwargs)
+        key = (peer_id, *sorted(kwargs.items()))
+        return await self.names.get_or_fetch(
+            key, self._render_name, get_entity, **kwargs)
+
     async def get_title(self, event, **kwargs):
-        real_chat_id, _ = utils.resolve_id(event.chat_id)
+        # telethon derives chat_id and sender_id anew on every access
+        chat_id, sender_id = event.chat_id, event.sender_id
         topic_id, topic_name = await get_topic(event)
         if topic_name is None:
             topic_rep = ""
         else:
+            real_chat_id, _ = utils.resolve_id(chat_id)
             topic_rep = topic_template % (
                 real_chat_id, topic_id, "#" + topic_name)
-        chat_and_topic = "".join((self.displayname(await event.get_chat(), clickable=True, **kwargs),
-                     topic_rep))
-        if event.chat_id == event.sender_id:
+        chat_and_topic = "".join((
+            await self.render_name(chat_id, event.get_chat, **kwargs),
+            topic_rep))
+        if chat_id == sender_id:
             return "<b>[%s]</b>:" % chat_and_topic
         return "<b>[%s]\n%s</b>:" % (
             chat_and_topic,
-            self.displayname(await event.get_sender(), **kwargs, clickable=True))
+            await self.render_name(sender_id, event.get_sender, **kwargs))
 
     async def log_msg(self, event, msg):
+        if self.dispatcher.should_shed("log_msg"):
+            return
         title = await self.get_title(event, showid=True)
         await self.log("%s\n%s\n└➤%s" % (title, to_html(event),
                                          tw.indent(to_html(msg), "  ")),
                        file=event.media if event.photo else None)
 
-    def run(self, init=None, *init_args, **init_kwargs):
-        with self.tg:
-            self.tg.loop.run_until_complete(self.startup(
-                init=init, *init_args, **init_kwargs))
+    async def stop(self, fini=None):
+        if self._metrics_task is not None:
+            self._metrics_task.cancel()
+            self._metrics_task = None
+        if fini is not None:
+            await fini()
+        await self.logs.stop()
+        await self.outbox.stop()
+        await self.tg.disconnect()  # type: ignore
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def run(self, init=None, *init_args, fini=None, **init_kwargs):
+        loop = self.tg.loop
+        try:
+            loop.run_until_complete(self.start(
+                init, *init_args, **init_kwargs))
             self.tg.run_until_disconnected()
+        finally:
+            loop.run_until_complete(self.stop(fini))
+
+    def _register(self, wrapper, on, params):
+        pattern = params.get("pattern")
+        if isinstance(pattern, str):
+            # commands may be addressed as /cmd@{username}
+            params = params | {"pattern": pattern.replace(
+                "{username}", re.escape(self.username))}  # type: ignore
+        self.tg.add_event_handler(wrapper, on(**params))
 
     def cmd(self, func=None, /, on=None, **params):
         if func is None:
             return partial(self.cmd, on=on, **params)
         on = on or partial(events.NewMessage, incoming=True)
+        name = func.__name__
 
-        @self.tg.on(on(**params))
         @wraps(func)
         async def wrapper(event: Event):
+            stats = self.metrics.stats(name)
+            stats.calls += 1
+            start = time.perf_counter()
             try:
-                print(event.message.date.ctime())
+                date = event.message.date
+                print(date.ctime())
+                stats.lag.observe(max(0., time.time() - date.timestamp()))
             except AttributeError:
                 print(datetime.now().ctime())
-            return await self.tryf(func, event)
+            token = metrics.current.set(stats)
+            # raw updates have no chat to keep in order
+            key = getattr(event, "chat_id", None)
+            try:
+                if key is None:
+                    res = await self.tryf(func, event)
+                else:
+                    with metrics.waiting("queue"):
+                        await self.dispatcher.acquire(key)
+                    try:
+                        res = await self.tryf(func, event)
+                    finally:
+                        self.dispatcher.release(key)
+            finally:
+                metrics.current.reset(token)
+                stats.latency.observe(time.perf_counter() - start)
+            if isinstance(res, Exception):
+                stats.errors += 1
+            return res
+        self.handlers.append((wrapper, on, params))
+        if self.tg is not None:
+            self._register(wrapper, on, params)
         return wrapper
 
     async def tryf(self, coro, *args, allow_exc=True, allow_excs=None,
@@ -182,86 +386,59 @@ topic_name: str
 raid_topic: int
 
 async def init_db():
-    async with aiosqlite.connect(dbfile) as conn:
-        await conn.execute(
-            "PRAGMA foreign_keys = ON")
-        async with conn.execute("PRAGMA journal_mode = WAL") as cur:
-            row = await cur.fetchone()
-            assert row is not None
-            mode, = row
-            assert mode == 'wal', "Could not enable WAL mode..."
-        await conn.execute(
-            "CREATE TABLE IF NOT EXISTS tw_posts ("
-            "tw_username TEXT NOT NULL, "
-            "tw_post_id INTEGER NOT NULL, "
-            "tg_msg_by INTEGER NOT NULL, "
-            "tg_msg_at INTEGER NOT NULL, "
-            "tg_msg_chat INTEGER NOT NULL, "
-            "tg_msg_id INTEGER NOT NULL, "
-            "tg_msg_topic INTEGER, "
-            "url TEXT)"
-        )
-        await conn.execute(
-            "CREATE TABLE IF NOT EXISTS topics ("
-            "topic_chat INTEGER NOT NULL, "
-            "topic_id INTEGER NOT NULL, "
-            "topic_name TEXT NOT NULL)"
-        )
-        await conn.execute(
-            "CREATE TABLE IF NOT EXISTS raid_topics ("
-            "topic_chat INTEGER NOT NULL UNIQUE, "
-            "topic_id INTEGER NOT NULL, "
-            "FOREIGN KEY (topic_chat) "
-            "REFERENCES topics (topic_chat), "
-            "FOREIGN KEY (topic_id) "
-            "REFERENCES topics (topic_id))"
-        )
-        await conn.execute(
-            "CREATE TABLE IF NOT EXISTS linked_chats ("
-            "linked_chat_id INTEGER NOT NULL, "
-            "chat_id INTEGER NOT NULL, "
-            "FOREIGN KEY (chat_id) "
-            "REFERENCES topics (topic_chat),"
-            "UNIQUE (chat_id, linked_chat_id))"
-        )
-        await conn.execute(
-            "CREATE UNIQUE INDEX IF NOT EXISTS idx_tw_posts "
-            "ON tw_posts (tw_username, tw_post_id, tg_msg_chat)")
-        await conn.execute(
-            "CREATE UNIQUE INDEX IF NOT EXISTS idx_topics "
-            "ON topics (topic_chat, topic_id)")
-        async with conn.execute("SELECT * FROM topics") as cur:
-            async for row in cur:
-                chat_id, topic_id, topic_name = row
-                _topicid2name_cache[(chat_id, topic_id)] = topic_name
-        await conn.execute(
-            "CREATE UNIQUE INDEX IF NOT EXISTS idx_linked_chats "
-            "ON linked_chats (chat_id, linked_chat_id)")
-        async with conn.execute("SELECT * FROM raid_topics") as cur:
-            async for row in cur:
-                chat_id, topic_id = row
-                raid_topics[chat_id] = topic_id
-        async with conn.execute("SELECT * FROM linked_chats") as cur:
-            async for row in cur:
-                linked_chat_id, chat_id = row
-                linked_chats[linked_chat_id] = chat_id
-        await conn.commit()
-
-chat_types = {}
+    await db.open()
+    await migrate(db)
+    await maintenance.start(is_quiet=lambda: not (hr.dispatcher.running
+                                                  or hr.dispatcher.depth))
+    tw_posts.start()
+    # workers index their own shards of tw_posts
+    await asyncio.gather(
+        *([] if workers.count else [tw_posts.warm()]),
+        deletions.start(partial(hr.tryf, hr.tg.delete_messages,
+                                allow_exc=False),
+                        ready=hr.connected))
+    notices.start(send_notice, edit_notice, expire_notice)
+    await workers.start()
+
+async def init_bot():
+    await init_db()
+    await hr.connected.wait()
+    await prefetch_raid_topics()
+    await resume_backfills()
+
+async def fini_db():
+    await hr.log("<pre>%s</pre>" % escape(cache.format_stats()))
+    await stop_backfills()
+    await deletions.stop()
+    await workers.stop()
+    await maintenance.stop()
+    await tw_posts.stop()
+    await db.close()
+
+# a group switching topics on or off sends an UpdateChannel,
+# the ttl covers the updates a bot misses
+chat_types = TTLCache(maxsize=8192, ttl=60 * 60, name="chat_types")
+chat_types.invalidate_on(
+    types.UpdateChannel,
+    key=lambda update: utils.get_peer_id(
+        types.PeerChannel(update.channel_id)))
+
 async def get_chat_type(event: Event):
     msg: Message = event.message if isinstance(event, Event) else event
     c_id = event.chat_id
-    if c_id in chat_types:
-        return chat_types[c_id]
+    chat_type = chat_types.get(c_id, missing)
+    if chat_type is not missing:
+        return chat_type
     chat = await event.get_chat()
     assert chat
     if msg.is_private:
-        chat_types[c_id] = "private"
+        chat_type = "private"
     elif getattr(chat, "forum", False):
-        chat_types[c_id] = "topics"
+        chat_type = "topics"
     else:
-        chat_types[c_id] = "group"
-    return chat_types[c_id]
+        chat_type = "group"
+    chat_types[c_id] = chat_type
+    return chat_type
 
 async def first_reply(event: Event,
                       stop_at=None):
@@ -271,52 +448,99 @@ async def first_reply(event: Event,
         event = await event.get_reply_message()
     return event
 
-_topicid2name_cache = {}
+_topicid2name_cache = TTLCache(maxsize=16384, name="topic_names")
+
+upsert_topic_sql = (
+    "INSERT INTO topics (topic_chat, topic_id, topic_name) "
+    "VALUES (?, ?, ?) "
+    "ON CONFLICT (topic_chat, topic_id) "
+    "DO UPDATE SET topic_name = excluded.topic_name")
+
+# forum topics api page size limit
+topics_page_size = 100
+
+async def fetch_topics(chat_id):
+    channel = await hr.tg.get_input_entity(chat_id)
+    names = {1: "General"}
+    offset_date, offset_id, offset_topic = None, 0, 0
+    while True:
+        res = await hr.tg(functions.channels.GetForumTopicsRequest(
+            channel=channel, offset_date=offset_date, offset_id=offset_id,
+            offset_topic=offset_topic, limit=topics_page_size))
+        for topic in res.topics:
+            if isinstance(topic, types.ForumTopic):
+                names[topic.id] = topic.title
+        if len(res.topics) < topics_page_size:
+            break
+        last = res.topics[-1]
+        offset_topic = last.id
+        if isinstance(last, types.ForumTopic):
+            offset_id = last.top_message
+            offset_date = next((m.date for m in res.messages
+                                if m.id == offset_id), last.date)
+    await db.executemany(upsert_topic_sql,
+                         [(chat_id, topic_id, topic_name)
+                          for topic_id, topic_name in names.items()])
+    for topic_id, topic_name in names.items():
+        _topicid2name_cache[(chat_id, topic_id)] = topic_name
+    return names
+
+# a chat is fetched again on a miss at most once per ttl,
+# topic updates keep the cache current in between
+_topic_fetches = TTLCache(maxsize=1024, ttl=60, name="topic_fetches")
+async def prefetch_topics(chat_id):
+    return await _topic_fetches.get_or_fetch(chat_id, fetch_topics, chat_id)
+
+async def prefetch_raid_chat(chat_id):
+    # the topics and entity of a chat, and its name as titles render it
+    await asyncio.gather(
+        prefetch_topics(chat_id),
+        hr.render_name(chat_id, partial(hr.tg.get_entity, chat_id)))
+
+async def prefetch_raid_topics():
+    rows = await db.fetchall("SELECT topic_chat FROM raid_topics")
+    await asyncio.gather(*(hr.tryf(prefetch_raid_chat, chat_id)
+                           for chat_id, in rows))
+
+async def load_topic_name(chat_id, topic_id):
+    row = await db.fetchone(
+        "SELECT topic_name FROM topics "
+        "WHERE topic_chat = ? AND topic_id = ?",
+        (chat_id, topic_id))
+    return row[0] if row else None
 
 async def topicid2name(event: Event,
                        topic_id):
     key = (event.chat_id, topic_id)
-    if key in _topicid2name_cache:
-        return _topicid2name_cache[key]
+    topic_name = await _topicid2name_cache.get_or_fetch(
+        key, load_topic_name, *key)
+    if topic_name is not None:
+        return topic_name
+    names = await hr.tryf(prefetch_topics, event.chat_id)
+    if isinstance(names, dict) and topic_id in names:
+        return names[topic_id]
     if topic_id == 1:
         topic_name = "General"
     else:
         topic_name = (await first_reply(event, stop_at=topic_id)
                       ).action.title  # type: ignore
-    try:
-        async with aiosqlite.connect(dbfile) as conn:
-            await conn.execute(
-                "INSERT INTO topics (topic_chat, topic_id, topic_name) "
-                "VALUES (?, ?, ?)",
-                (*key, topic_name))
-            await conn.commit()
-        _topicid2name_cache[key] = topic_name
-        return topic_name
-    except sqlite3.IntegrityError:
-        try:
-            return _topicid2name_cache[key]
-        except KeyError:
-            await hr.log("key not found: %s " % key)
+    _topicid2name_cache[key] = topic_name
+    await db.execute(upsert_topic_sql, (*key, topic_name))
+    return topic_name
+
+def message_topic_id(msg: Message):
+    reply_to = msg.reply_to
+    if not reply_to or not reply_to.forum_topic:  # type: ignore
+        return 1
+    return (getattr(reply_to, "reply_to_top_id", None)
+            or reply_to.reply_to_msg_id)  # type: ignore
 
 async def get_topic(event: Event):
     chat_type = await get_chat_type(event)
     if chat_type != "topics":
         return None, None
     msg: Message = event.message if isinstance(event, Event) else event
-    reply_to = msg.reply_to
-    if not reply_to or not reply_to.forum_topic:  # type: ignore
-        topic_id = 1
-        topic_name = await topicid2name(event, topic_id)
-        return topic_id, topic_name
-    topic_id = reply_to.reply_to_msg_id  # type: ignore
-    try:
-        reply_to_top_id = reply_to.reply_to_top_id  # type: ignore
-        if reply_to_top_id:
-            topic_id = reply_to_top_id
-        else:
-            topic_id = reply_to.reply_to_msg_id  # type: ignore
-    except AttributeError:
-        ...
+    topic_id = message_topic_id(msg)
     topic_name = await topicid2name(event, topic_id)
     return topic_id, topic_name
 
@@ -324,44 +548,56 @@ async def extract_info(event: Event):
     tg_msg_by = event.sender_id
     tg_msg_at = int((event.date or datetime.now(tz=tz.utc)).timestamp())
     tg_msg_chat = event.chat_id
-    real_chat_id, _ = utils.resolve_id(tg_msg_chat)
     tg_msg_topic, topic_name = await get_topic(event)
     tg_msg_id = event.id
-    url = None
-    if not event.is_private:
-        url = msg_url_template % (real_chat_id, tg_msg_id)
+    url = message_url(tg_msg_chat, tg_msg_id)
     return (tg_msg_by, tg_msg_at,
             tg_msg_chat, (tg_msg_topic, topic_name), tg_msg_id,
             url)
 
-twitter_url_pattern = re.compile(
-    "<a href=\"(?P<href>"
-    r"(?:https?://)?(?:x|twitter).com?/"
-    r"(?P<tw_username>[^/]*)/status/"
-    r"(?P<tw_post_id>\d+)([/?]?\S*)?"
-    ")\">(?:.*?(?=</a>))</a>",
-    re.MULTILINE | re.DOTALL | re.IGNORECASE
-)
-
-parse_mode = utils.sanitize_parse_mode("html")
 def to_html(event: Event):
-    return parse_mode.unparse(event.raw_text, event.entities)  # type: ignore
+    return unparse(event.raw_text, event.entities)
 
 def from_html(text):
     return parse_mode.parse(text)  # type: ignore
 
-link_template = '<a href="%s">%s</a>'
-dup_template = link_template % ('%s', 'Marked as duplicate')
-tw_url_template = "https://x.com/%s/status/%s"
 quote_template = "<blockquote>%s</blockquote>"
-msg_url_template = "https://t.me/c/%s/%s"
 topic_template = link_template % (msg_url_template, '%s')
 
-hr = HalfRed(username=os.environ["TG_BOT_USERNAME"],
-             api_id=os.environ["TG_API_ID"],
-             api_hash=os.environ["TG_API_HASH"],
-             bot_token=os.environ["TG_BOT_TOKEN"],
-             log_channel=os.environ["TG_LOG_CHANNEL"])
+hr = HalfRed()
+# renames the bot is told about, the ttl covers the others.
+# chat title edits are service messages, see _raw
+hr.names.invalidate_on(
+    types.UpdateUser, types.UpdateUserName,
+    group=lambda update: update.user_id)
+hr.names.invalidate_on(
+    types.UpdateChannel,
+    group=lambda update: utils.get_peer_id(
+        types.PeerChannel(update.channel_id)))
+hr.names.invalidate_on(
+    types.UpdateChat,
+    group=lambda update: utils.get_peer_id(
+        types.PeerChat(update.chat_id)))
+hr.reporters.append(maintenance.format)
+hr.reporters.append(workers.format)
+hr.reporters.append(notices.format)
+
+def create_app(env=os.environ, client=None, **clientparams):
+    maintenance.retention_days = int(env.get("RETENTION_DAYS", 30))
+    workers.count = int(env.get("DEDUP_WORKERS", 0))
+    if workers.count:
+        # the workers write to the same file
+        db.busy_timeout = workers.busy_timeout
+    return hr.configure(username=env["TG_BOT_USERNAME"],
+                        api_id=env["TG_API_ID"],
+                        api_hash=env["TG_API_HASH"],
+                        bot_token=env["TG_BOT_TOKEN"],
+                        log_channel=env["TG_LOG_CHANNEL"],
+                        metrics_interval=env.get("METRICS_INTERVAL"),
+                        max_running=env.get("MAX_RUNNING_HANDLERS"),
+                        shed_depth=env.get("SHED_QUEUE_DEPTH"),
+                        record_dir=env.get("RECORD_UPDATES"),
+                        client=client, **clientparams)
 
 @hr.cmd(on=events.Raw)
 async def _raw(event: Event):
@@ -371,6 +607,10 @@ async def _raw(event: Event):
     if not isinstance(msg, types.MessageService):
         return
     action = msg.action
+    if isinstance(action, types.MessageActionChatEditTitle):
+        chat_id = utils.get_peer_id(msg.peer_id)
+        hr.names.invalidate_group(chat_id)
+        return
     if not isinstance(action, (types.MessageActionTopicEdit,
                                types.MessageActionTopicCreate)):
         return
@@ -386,28 +626,39 @@ async def _raw(event: Event):
         topic_id = msg.id  # type: ignore
     key = chat_id, topic_id
     _topicid2name_cache[key] = topic_name
-    async with aiosqlite.connect(dbfile) as conn:
-        await conn.execute(
-            "INSERT INTO topics (topic_chat, topic_id, topic_name) "
-            "VALUES (?, ?, ?) "
-            "ON CONFLICT (topic_chat, topic_id) "
-            "DO UPDATE SET topic_name = ?",
-            (*key, topic_name, topic_name))
-        await conn.commit()
-
-missing = object()
-
-_permissions_cache = {}
+    await db.execute(upsert_topic_sql, (*key, topic_name))
+
+def self_destruct(chat_id, *msg_ids, delay=sleep_time):
+    deletions.schedule(chat_id, msg_ids, delay)
+
+async def send_notice(chat_id, topic_id, text):
+    return await hr.send(chat_id, text, reply_to=topic_id, parse_mode="html")
+
+async def edit_notice(chat_id, msg_id, text):
+    return await hr.edit(chat_id, msg_id, text, parse_mode="html")
+
+def expire_notice(chat_id, msg_id, delay):
+    self_destruct(chat_id, msg_id, delay=delay)
+
+_permissions_cache = TTLCache(maxsize=4096, ttl=5 * 60, name="permissions")
+_permissions_cache.invalidate_on(
+    types.UpdateChannelParticipant,
+    key=lambda update: (
+        utils.get_peer_id(types.PeerChannel(update.channel_id)),
+        update.user_id))
+_permissions_cache.invalidate_on(
+    types.UpdateChatParticipant, types.UpdateChatParticipantAdmin,
+    key=lambda update: (
+        utils.get_peer_id(types.PeerChat(update.chat_id)),
+        update.user_id))
+_permissions_cache.invalidate_on(
+    types.UpdateChatParticipants,
+    pred=lambda update, key: key[0] == utils.get_peer_id(
+        types.PeerChat(update.participants.chat_id)))
+
 async def get_permissions(chat, user):
-    key = (chat, user)
-    if key in _permissions_cache:
-        permissions, ttl = _permissions_cache[key]
-        if ttl < datetime.now().timestamp():
-            return permissions
-    permissions = await hr.tg.get_permissions(chat, user)
-    ttl = datetime.now().timestamp() + 5 * 60
-    _permissions_cache[key] = permissions, ttl
-    return permissions
+    return await _permissions_cache.get_or_fetch(
+        (chat, user), hr.tg.get_permissions, chat, user)
 
 async def has_permission(event: Event, **perms):
     chat_id, sender_id = event.chat_id, event.sender_id
@@ -419,7 +670,8 @@ async def has_permission(event: Event, **perms):
             raise AttributeError("Permission %s is missing" %
                                  perm_name)
         if user_perm != perm_value:
-            res = await event.reply(
+            res = await hr.reply(
+                event,
                 "\n\n".join([
                     "<b>Permission denied:</b>",
                     ("<i>To perform this action, "
@@ -432,13 +684,11 @@ async def has_permission(event: Event, **perms):
                     ),
                 ]),
                 parse_mode="html")
-            await asyncio.sleep(sleep_time)
-            await hr.tryf(hr.tg.delete_messages,
-                          chat_id, (event.id, res.id))
+            self_destruct(chat_id, event.id, res.id)
             return False
     return True
 
-@hr.cmd(pattern=rf"^/ignore_duplicate(?:@{hr.username})?(?:\s+(?P<msg>.*))?")
+@hr.cmd(pattern=r"^/ignore_duplicate(?:@{username})?(?:\s+(?P<msg>.*))?")
 async def _ignore_duplicate(event: Event):
     if not await has_permission(event, is_admin=True, change_info=True):
         return
@@ -448,226 +698,409 @@ async def _ignore_duplicate(event: Event):
     g = m.groupdict()
     msg = g["msg"]
     if not msg:
-        res = await event.reply("\n\n".join([
+        res = await hr.reply(event, "\n\n".join([
             "<b>Error:</b>",
             "/ignore_duplicate <i>needs a message after the command</i>",
         ]),
             parse_mode="html")
-        await asyncio.sleep(sleep_time)
-        return await hr.tryf(hr.tg.delete_messages,
-                             event.chat_id, (event.id, res.id))
+        return self_destruct(event.chat_id, event.id, res.id)
     await dedup(event, ignore_duplicate=True,
                 ignore_prefix=r"/ignore_duplicate")
     await hr.tryf(event.delete)
     raise events.StopPropagation
 
+# dedup runs a message through extract -> classify -> persist -> respond,
+# each stage recording its results on a WorkItem. the stages skip what an
+# item already holds, so a linked chat's repost is classified from its
+# source and the message it was sent as, and a retried item only sends
+# what it hasn't yet
+
+def extract(event: Event, **flags):
+    return WorkItem(event.raw_text, event.entities, event.is_private,
+                    extract_links(event.raw_text, event.entities),
+                    hr.username, **flags)
+
+async def classify(item: WorkItem, event: Event):
+    # false for the chats without a raid topic
+    if item.raid_topic is None:
+        item.raid_topic = await get_raid_topic(event.chat_id)
+        if item.raid_topic is None:
+            return False
+    if item.url is None:
+        (item.sender_id, item.date, item.chat_id, (item.topic_id, _),
+         item.msg_id, item.url) = await extract_info(event)
+    return True
+
+def classify_repost(source: WorkItem, chat_id, raid_topic, msg: Message):
+    # the copy of source sent to chat_id, known without asking for it
+    item = WorkItem(msg.raw_text, msg.entities, False, source.links,
+                    hr.username, ignore_duplicate=True, skip_repost=True)
+    item.raid_topic = item.topic_id = raid_topic
+    item.chat_id = chat_id
+    item.msg_id = msg.id
+    item.sender_id = msg.sender_id
+    item.date = int((msg.date or datetime.now(tz=tz.utc)).timestamp())
+    item.url = message_url(chat_id, msg.id)
+    return item
+
+async def persist(item: WorkItem, event: Event):
+    # stores the posts and plans the response, in a worker if any
+    if item.actions is not None:
+        return item.actions
+    if not workers.count:
+        return await plan_dedup(item, tw_posts, partial(hr.get_title, event))
+    # workers have no client to render the title with
+    if not item.skip_repost and item.title is None:
+        item.title = await hr.get_title(event)
+    item.actions = await workers.submit(item)
+    return item.actions
+
+async def respond(item: WorkItem, event: Event):
+    for action, response in item.actions[item.sent:]:  # type: ignore
+        if action == "reply":
+            await hr.reply(event, response,
+                           priority=REPOST, parse_mode="html")
+        elif action == "notice":
+            # a raid's duplicates share one notice per topic
+            self_destruct(item.chat_id, item.msg_id)
+            notices.add(item.chat_id, item.topic_id,
+                        await hr.render_name(item.sender_id,
+                                             event.get_sender),
+                        response)
+        elif action == "repost":
+            await hr.send(
+                item.chat_id, response,
+                reply_to=item.raid_topic,
+                priority=REPOST,
+                parse_mode="html")
+        item.sent += 1
+
+async def repost_linked(chat_id, text, source: WorkItem):
+    # true once the repost is sent
+    raid_topic = await get_raid_topic(chat_id)
+    if not raid_topic:
+        return False
+    msg = await hr.send(
+        chat_id, text,
+        reply_to=raid_topic,
+        priority=REPOST,
+        parse_mode="html")
+    if source.links:
+        await hr.tryf(dedup, msg, item=classify_repost(source, chat_id,
+                                                       raid_topic, msg))
+    return True
+
 @hr.cmd
 async def _dedup(event: Event):
     real_chat_id, _ = utils.resolve_id(event.chat_id)
-    if real_chat_id in linked_chats:
-        linked_chat_id = linked_chats[real_chat_id]
-        raid_topic = raid_topics.get(linked_chat_id, None)
-        if raid_topic:
-            msg = await hr.tg.send_message(
-                linked_chat_id,
-                "%s\n%s" % (
-                    await hr.get_title(event),
-                    to_html(event),
-                ),
-                reply_to=raid_topic,
-                parse_mode="html")
-            return await dedup(msg, ignore_duplicate=True, skip_repost=True)
-    return await dedup(event)
+    chat_ids = await get_linked_chats(real_chat_id)
+    if not chat_ids:
+        return await dedup(event)
+    # parsed and rendered once for all the chats it feeds,
+    # one failing doesn't hold up the others
+    source = extract(event)
+    text = "%s\n%s" % (await hr.get_title(event), item_html(source))
+    reposted = await asyncio.gather(*(
+        hr.tryf(repost_linked, chat_id, text, source)
+        for chat_id in chat_ids))
+    # deduped in its own chat unless it reached one of them
+    if not any(r is True for r in reposted):
+        return await dedup(event, item=source)
 
 async def dedup(event: Event, ignore_duplicate=False,
-                ignore_prefix=None, skip_repost=False):
-    text = to_html(event)
-    if ignore_prefix:
-        text = text.lstrip(ignore_prefix).lstrip("@%s" % hr.username).strip()
-    if not text:
-        return
-    if event.chat_id not in raid_topics:
+                ignore_prefix=None, skip_repost=False,
+                item: WorkItem | None = None):
+    # plain chat messages stop here, without rendering any html
+    if item is None:
+        item = extract(event, ignore_duplicate=ignore_duplicate,
+                       ignore_prefix=ignore_prefix, skip_repost=skip_repost)
+    if not item.links:
         return
-    tg_msg_by, tg_msg_at, tg_msg_chat, topic, tg_msg_id, url = await extract_info(event)
-    tg_msg_topic, topic_name = topic
-    event_topic = tg_msg_topic
-    raid_topic = raid_topics[tg_msg_chat]
-    response_ok = []
-    response_duplicate = []
-    match = ""
-    has_duplicates, has_more_text, has_url = False, False, False
-    last_end, start, end = 0, 0, 0
-    for m in twitter_url_pattern.finditer(text):
-        if not m:
-            continue
-        has_url = True
-        start, end = m.span()
-        match = text[start:end]
-        g = m.groupdict()
-        tw_username = g["tw_username"]
-        tw_post_id = g["tw_post_id"]
-        try:
-            async with aiosqlite.connect(dbfile) as conn:
-                await conn.execute(
-                    "INSERT INTO tw_posts ("
-                    "tw_username, "
-                    "tw_post_id, "
-                    "tg_msg_by, "
-                    "tg_msg_at, "
-                    "tg_msg_chat, "
-                    "tg_msg_id, "
-                    "tg_msg_topic, "
-                    "url) "
-                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                    (tw_username, tw_post_id,
-                     tg_msg_by, tg_msg_at,
-                     tg_msg_chat, tg_msg_topic, tg_msg_id,
-                     url))
-                await conn.commit()
-            response_ok.append(text[last_end:end])
-            more_text = text[last_end:start]
-            if more_text.strip():
-                has_more_text = True
-        except sqlite3.IntegrityError:
-            has_duplicates = True
-            async with aiosqlite.connect(dbfile) as conn:
-                cur = await conn.execute(
-                    "SELECT * "
-                    "FROM tw_posts "
-                    "WHERE tw_username = ? "
-                    "AND tw_post_id = ? "
-                    "AND tg_msg_chat = ?",
-                    (tw_username, tw_post_id, tg_msg_chat)
-                )
-                row = await cur.fetchone()
-                assert row
-                (tw_username, tw_post_id,
-                 tg_msg_by, tg_msg_at,
-                 tg_msg_chat, tg_msg_id, tg_msg_topic,
-                 url) = row
-            # if end != 0 and last_end != end:
-            more_text = text[last_end:start]
-            if more_text.strip():
-                has_more_text = True
-            if event.is_private:
-                if ignore_duplicate:
-                    response_ok.append(text[last_end:end])
-                else:
-                    response_ok.append("%s%s" % (
-                        more_text,
-                        dup_template % escape(
-                            tw_url_template % (
-                                tw_username,
-                                tw_post_id))))
-            elif ignore_duplicate:
-                response_ok.append(text[last_end:end])
-            else:
-                response_ok.append("%s%s" % (
-                    more_text,
-                    dup_template % escape(url)))
-            response_duplicate.append("%s\n" % (
-                match))
-        last_end = end
-    has_more_text = has_more_text or match and end != len(text)
-    response = "".join((*response_ok, text[end:]))
-    response = "\n".join((await hr.get_title(event), response))
-    if skip_repost:
+    if not await classify(item, event):
         return
-    if event_topic == raid_topic:
-        if has_duplicates:
-            if has_more_text or ignore_duplicate:
-                await event.reply(response, parse_mode="html")
-            if not ignore_duplicate:
-                duplicates = await event.reply(
-                    "\n\n".join([
-                        "Duplicate posts:",
-                        *(r.strip() for r in response_duplicate),
-                        "This message will self-destruct in %ss" % sleep_time
-                    ]),
-                    parse_mode="html")
-                await asyncio.sleep(sleep_time)
-                await hr.tryf(hr.tg.delete_messages,
-                              event.chat_id, (event.id, duplicates.id))
-
-    elif has_url and (not has_duplicates or ignore_duplicate):
-        await hr.tg.send_message(
-            event.chat_id, response,
-            reply_to=raid_topic,
-            parse_mode="html")
+    await persist(item, event)
+    await respond(item, event)
+
+# chats without a raid topic are cached as None. the commands update
+# it on write, the ttl picks up rows written by anything else
+raid_topics = TTLCache(maxsize=8192, ttl=5 * 60, name="raid_topics")
+async def load_raid_topic(chat_id):
+    row = await db.fetchone(
+        "SELECT topic_id FROM raid_topics WHERE topic_chat = ?",
+        (chat_id,))
+    return row[0] if row else None
+
+async def get_raid_topic(chat_id):
+    return await raid_topics.get_or_fetch(chat_id, load_raid_topic, chat_id)
 
-raid_topics: dict[int, int] = {}
 @hr.cmd(pattern="/set_raid_topic")
 async def _set_raid_topic(event: Event):
     if await get_chat_type(event) != "topics":
-        res = await event.reply("\n\n".join([
+        res = await hr.reply(event, "\n\n".join([
             "<b>Error:</b>",
             ("/set_raid_topic <i>can only be used in "
              "group chats with topics enabled.</i>"),
         ]),
             parse_mode="html")
-        await asyncio.sleep(sleep_time)
-        return await hr.tryf(hr.tg.delete_messages,
-                             event.chat_id, (event.id, res.id))
+        return self_destruct(event.chat_id, event.id, res.id)
     if not await has_permission(event, is_admin=True, change_info=True):
         return
     topic_id, topic_name = await get_topic(event)
-    async with aiosqlite.connect(dbfile) as conn:
-        await conn.execute(
-            "INSERT INTO raid_topics (topic_chat, topic_id) "
-            "VALUES (?, ?) "
-            "ON CONFLICT (topic_chat) "
-            "DO UPDATE SET topic_id = ?",
-            (event.chat_id, topic_id, topic_id))
-        await conn.commit()
+    await db.execute(
+        "INSERT INTO raid_topics (topic_chat, topic_id) "
+        "VALUES (?, ?) "
+        "ON CONFLICT (topic_chat) "
+        "DO UPDATE SET topic_id = ?",
+        (event.chat_id, topic_id, topic_id))
     raid_topics[event.chat_id] = topic_id
+    start_backfill(event.chat_id, topic_id, event.id - 1)
     real_chat_id, _ = utils.resolve_id(event.chat_id)
-    res = await event.reply(
+    res = await hr.reply(
+        event,
         "<i>Raid topic</i> set to <b>%s</b>" % topic_template % (
             real_chat_id, topic_id, topic_name),
         parse_mode="html")
     await hr.log_msg(event, res)
-    await asyncio.sleep(sleep_time)
-    await hr.tryf(hr.tg.delete_messages,
-                  event.chat_id, (event.id, res.id))
+    self_destruct(event.chat_id, event.id, res.id)
 
 @hr.cmd(pattern="/raid_topic")
 async def _raid_topic(event: Event):
     if await get_chat_type(event) != "topics":
-        res = await event.reply("\n\n".join([
+        res = await hr.reply(event, "\n\n".join([
             "<b>Error:</b>",
             ("/raid_topic <i>can only be used in "
              "group chats with topics enabled.</i>"),
         ]),
             parse_mode="html")
-        await asyncio.sleep(sleep_time)
-        return await hr.tryf(hr.tg.delete_messages,
-                             event.chat_id, (event.id, res.id))
+        return self_destruct(event.chat_id, event.id, res.id)
     if not await has_permission(event, is_admin=True, change_info=True):
         return
     chat_id = event.chat_id
-    if chat_id not in raid_topics:
-        res = await event.reply(
+    topic_id = await get_raid_topic(chat_id)
+    if topic_id is None:
+        res = await hr.reply(
+            event,
             "\n\n".join((
                 "Raid topic is not set",
                 "Use /set_raid_topic in a topic to set it as raid topic",
             )),
             parse_mode="html")
-        await asyncio.sleep(sleep_time)
-        return await hr.tryf(hr.tg.delete_messages,
-                             chat_id, (event.id, res.id))
-    topic_id = raid_topics[chat_id]
+        return self_destruct(chat_id, event.id, res.id)
     topic_name = await topicid2name(event, topic_id)
     real_chat_id, _ = utils.resolve_id(chat_id)
-    res = await event.reply(
+    res = await hr.reply(
+        event,
         "<i>Raid topic</i> is <b>%s</b>" % topic_template % (
             real_chat_id, topic_id, topic_name),
         parse_mode="html")
     await hr.log_msg(event, res)
-    await asyncio.sleep(sleep_time)
-    await hr.tryf(hr.tg.delete_messages,
-                  chat_id, (event.id, res.id))
+    self_destruct(chat_id, event.id, res.id)
+
+# bots can't list a topic's history: message ids are fetched by chunks,
+# newest first down to the topic's first message, and the posts found
+# are committed by batches along with the resume cursor
+backfill_chunk = 100
+backfill_batch = 1000
+backfill_save_every = 20
+backfills: dict[int, asyncio.Task] = {}
+
+upsert_backfill_sql = (
+    "INSERT INTO backfills (chat_id, topic_id, next_id, posts) "
+    "VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (chat_id) DO UPDATE SET "
+    "topic_id = excluded.topic_id, "
+    "next_id = excluded.next_id, "
+    "posts = excluded.posts")
+
+async def backfill(chat_id, topic_id, next_id, posts=0):
+    rows = []
+    chunks = 0
+    while next_id > topic_id:
+        ids = list(range(next_id, max(topic_id, next_id - backfill_chunk),
+                         -1))
+        for msg in await hr.tg.get_messages(chat_id, ids=ids):
+            if (msg is None or isinstance(msg, types.MessageService)
+                    or message_topic_id(msg) != topic_id):
+                continue
+            for link in extract_links(msg.raw_text, msg.entities):
+                rows.append((link.tw_username, link.tw_post_id,
+                             msg.sender_id, int(msg.date.timestamp()),
+                             chat_id, msg.id, topic_id,
+                             message_url(chat_id, msg.id)))
+        next_id = ids[-1] - 1
+        chunks += 1
+        if (len(rows) >= backfill_batch or chunks >= backfill_save_every
+                or next_id <= topic_id):
+            posts += len(rows)
+            await tw_posts.backfill(rows, (
+                upsert_backfill_sql, (chat_id, topic_id, next_id, posts)))
+            rows = []
+            chunks = 0
+    return posts
+
+async def run_backfill(chat_id, topic_id, next_id, posts=0):
+    # not a handler's work, don't charge its waits to the caller
+    metrics.current.set(None)
+    res = await hr.tryf(backfill, chat_id, topic_id, next_id, posts)
+    if isinstance(res, Exception):
+        return
+    real_chat_id, _ = utils.resolve_id(chat_id)
+    topic_name = _topicid2name_cache.get((chat_id, topic_id)) or topic_id
+    await hr.log("Backfilled %d posts from %s" % (
+        res, topic_template % (real_chat_id, topic_id, "#%s" % topic_name)))
+
+def start_backfill(chat_id, topic_id, next_id, posts=0):
+    task = backfills.get(chat_id)
+    if task is not None and not task.done():
+        task.cancel()
+    task = backfills[chat_id] = asyncio.create_task(
+        run_backfill(chat_id, topic_id, next_id, posts))
+    task.add_done_callback(partial(_backfill_done, chat_id))
+
+def _backfill_done(chat_id, task):
+    if backfills.get(chat_id) is task:
+        del backfills[chat_id]
+
+async def resume_backfills():
+    for chat_id, topic_id, next_id, posts in await db.fetchall(
+            "SELECT chat_id, topic_id, next_id, posts FROM backfills "
+            "WHERE next_id > topic_id"):
+        start_backfill(chat_id, topic_id, next_id, posts)
+
+async def stop_backfills():
+    tasks = list(backfills.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+@hr.cmd(pattern=r"^/backfill(?:@{username})?$")
+async def _backfill(event: Event):
+    if not await has_permission(event, is_admin=True, change_info=True):
+        return
+    chat_id = event.chat_id
+    topic_id = await get_raid_topic(chat_id)
+    if topic_id is None:
+        res = await hr.reply(
+            event,
+            "\n\n".join((
+                "Raid topic is not set",
+                "Use /set_raid_topic in a topic to set it as raid topic",
+            )),
+            parse_mode="html")
+        return self_destruct(chat_id, event.id, res.id)
+    row = await db.fetchone(
+        "SELECT topic_id, next_id, posts FROM backfills WHERE chat_id = ?",
+        (chat_id,))
+    if chat_id in backfills:
+        txt = "<i>Backfill</i> is running, %d posts so far" % (
+            row[2] if row else 0)
+    elif row and row[0] == topic_id and row[1] > topic_id:
+        start_backfill(chat_id, topic_id, row[1], row[2])
+        txt = "<i>Backfill</i> resumed, %d posts so far" % row[2]
+    else:
+        start_backfill(chat_id, topic_id, event.id - 1)
+        txt = "<i>Backfill</i> started"
+    res = await hr.reply(event, txt, parse_mode="html")
+    self_destruct(chat_id, event.id, res.id)
+
+@hr.cmd(pattern=r"^/retention(?:@{username})?(?:\s+(?P<days>\d+))?$")
+async def _retention(event: Event):
+    if not await has_permission(event, is_admin=True, change_info=True):
+        return
+    chat_id = event.chat_id
+    days = event.pattern_match["days"]
+    if days is None:
+        row = await db.fetchone(
+            "SELECT days FROM retention WHERE chat_id = ?", (chat_id,))
+        days = row[0] if row else maintenance.retention_days
+    else:
+        days = int(days)
+        await db.execute(
+            "INSERT INTO retention (chat_id, days) "
+            "VALUES (?, ?) "
+            "ON CONFLICT (chat_id) "
+            "DO UPDATE SET days = excluded.days",
+            (chat_id, days))
+    if days:
+        txt = "Posts count as duplicates for <b>%d days</b>" % days
+    else:
+        txt = "Posts count as duplicates <b>forever</b>"
+    res = await hr.reply(event, txt, parse_mode="html")
+    await hr.log_msg(event, res)
+    self_destruct(chat_id, event.id, res.id)
+
+# rollups are per utc day, see migrations.raid_stats
+day_seconds = 24 * 60 * 60
+raid_stats_top = 10
+
+async def raid_stats(chat_id, days, topic_id=None):
+    # sums over the daily buckets of the window, never over tw_posts
+    where = "WHERE tg_msg_chat = ? AND day > ?"
+    params = (chat_id, int(time.time()) // day_seconds - days)
+    if topic_id is not None:
+        where += " AND tg_msg_topic = ?"
+        params += (topic_id,)
+    daily = await db.fetchall(
+        "SELECT day, sum(posts) FROM daily_posts %s "
+        "GROUP BY day ORDER BY day DESC" % where, params)
+    sharers = await db.fetchall(
+        "SELECT tg_msg_by, sum(posts) AS shared FROM daily_sharers %s "
+        "GROUP BY tg_msg_by ORDER BY shared DESC LIMIT ?" % where,
+        (*params, raid_stats_top))
+    return daily, sharers
+
+async def get_sharer(user_id):
+    # users the session never met are shown by id
+    try:
+        return await hr.tg.get_entity(user_id)
+    except ValueError:
+        return user_id
+
+@hr.cmd(pattern=r"^/raid_stats(?:@{username})?"
+        r"(?:\s+(?P<days>\d+))?(?:\s+(?P<here>here))?$")
+async def _raid_stats(event: Event):
+    if not await has_permission(event, is_admin=True, change_info=True):
+        return
+    chat_id = event.chat_id
+    days = int(event.pattern_match["days"] or 7)
+    topic_id, topic_name = None, None
+    if event.pattern_match["here"]:
+        topic_id, topic_name = await get_topic(event)
+        # chats without topics are counted as topic 0
+        topic_id = topic_id or 0
+    daily, sharers = await raid_stats(chat_id, days, topic_id)
+    if topic_name is None:
+        scope = ""
+    else:
+        real_chat_id, _ = utils.resolve_id(chat_id)
+        scope = " in %s" % topic_template % (
+            real_chat_id, topic_id, "#" + topic_name)
+    lines = ["<b>Raid stats</b>, last %d days%s: <b>%d</b> posts" % (
+        days, scope, sum(posts for _, posts in daily))]
+    lines.extend("%s: %d" % (
+        datetime.fromtimestamp(day * day_seconds, tz=tz.utc).date(), posts)
+        for day, posts in daily)
+    if sharers:
+        users = await asyncio.gather(*(get_sharer(user_id)
+                                       for user_id, _ in sharers))
+        lines.append("\n<b>Top sharers</b>:")
+        lines.extend("%d. %s: %d" % (
+            rank, hr.displayname(user, showid=isinstance(user, int)), posts)
+            for rank, (user, (_, posts)) in enumerate(zip(users, sharers), 1))
+    await hr.reply(event, "\n".join(lines), parse_mode="html")
+
+# chats fed by a linked chat, unlinked chats are cached as ()
+linked_chats = TTLCache(maxsize=8192, ttl=5 * 60, name="linked_chats")
+async def load_linked_chats(linked_chat_id):
+    rows = await db.fetchall(
+        "SELECT chat_id FROM linked_chats WHERE linked_chat_id = ?",
+        (linked_chat_id,))
+    return tuple(chat_id for chat_id, in rows)
+
+async def get_linked_chats(linked_chat_id):
+    return await linked_chats.get_or_fetch(
+        linked_chat_id, load_linked_chats, linked_chat_id)
 
-linked_chats: dict[int, int] = {}
 pattern_linked_chat = (
     r"(?:\s+(?P<chat_info>"
         r"(?P<chat_id>\d+)"
@@ -676,7 +1109,7 @@ pattern_linked_chat = (
     "))?"
 )
 un = r"(?P<undo>un)?"
-@hr.cmd(pattern=rf"/{un}link_chat(?:@{hr.username})?{pattern_linked_chat}")
+@hr.cmd(pattern=rf"/{un}link_chat(?:@{{username}})?{pattern_linked_chat}")
 async def _link_chat(event: Event):
     if not await has_permission(event, is_admin=True, change_info=True):
         return
@@ -690,54 +1123,73 @@ async def _link_chat(event: Event):
         chat_link = f"t.me/{chat.username}"
     elif chat_info:
         if "+" in chat_info:
-            return await event.reply("Linked chat must be public")
+            return await hr.reply(event, "Linked chat must be public")
         if "@" in chat_info:
             chat = await hr.tg.get_entity(chat_info)
             chat_link = f"t.me/{chat.username}"
         if g["chat_link"]:
             chat_link = g["chat_link"]
         chat = await hr.tg.get_entity(chat_info)
+        # commands only arrive once connected
+        assert hr.me is not None
         try:
             await hr.tg.get_permissions(chat.id, hr.me.id)
         except errors.UserNotParticipantError:
-            return await event.reply("Bot must be member of this chat")
+            return await hr.reply(event, "Bot must be member of this chat")
         linked_chat_id = chat.id
     else:
-        return await event.reply("Invalid chat id")
+        return await hr.reply(event, "Invalid chat id")
     event_chat_id, _ = utils.resolve_id(event.chat_id)
     if linked_chat_id == event_chat_id:
-        return await event.reply("Cannot link to the same chat")
+        return await hr.reply(event, "Cannot link to the same chat")
     action = "Linked"
     try:
-        async with aiosqlite.connect(dbfile) as conn:
-            if undo:
-                action = "Un" + action.lower()
-                await conn.execute(
-                    "DELETE FROM linked_chats "
-                    "WHERE chat_id = ? "
-                    "AND linked_chat_id = ?",
-                    (event.chat_id, linked_chat_id))
-                await conn.commit()
-                linked_chats.pop(linked_chat_id)
-            else:
-                await conn.execute(
-                    "INSERT INTO linked_chats (linked_chat_id, chat_id) "
-                    "VALUES (?, ?)",
-                    (linked_chat_id, event.chat_id))
-                await conn.commit()
-                linked_chats[linked_chat_id] = event.chat_id
+        if undo:
+            action = "Un" + action.lower()
+            deleted = await db.execute(
+                "DELETE FROM linked_chats "
+                "WHERE chat_id = ? "
+                "AND linked_chat_id = ?",
+                (event.chat_id, linked_chat_id))
+            if not deleted:
+                raise KeyError(linked_chat_id)
+        else:
+            await db.execute(
+                "INSERT INTO linked_chats (linked_chat_id, chat_id) "
+                "VALUES (?, ?)",
+                (linked_chat_id, event.chat_id))
     except (sqlite3.IntegrityError, KeyError):
         txt = f"Chat already {action.lower()}"
-        msg = await event.reply(txt)
+        msg = await hr.reply(event, txt)
         return await hr.log_msg(event, msg)
+    # reloaded with every chat it feeds on next use
+    linked_chats.pop(linked_chat_id)
     linked_chat_title = hr.displayname(chat)
     txt = f"{action} chat %s" % link_template % (
             chat_link, linked_chat_title)
-    msg = await event.reply(txt, parse_mode="html")
+    msg = await hr.reply(event, txt, parse_mode="html")
     await hr.log_msg(event, msg)
 
+@hr.cmd(on=events.Raw, types=list(cache.invalidation_types()))
+async def _invalidate_caches(update):
+    cache.on_update(update)
+
+@hr.cmd(pattern=r"^/cache_stats(?:@{username})?$")
+async def _cache_stats(event: Event):
+    if event.chat_id != hr.log_channel:
+        return
+    await hr.reply(event, "<pre>%s</pre>" % escape(cache.format_stats()),
+                   parse_mode="html")
+
+@hr.cmd(pattern=r"^/metrics(?:@{username})?$")
+async def _metrics(event: Event):
+    if event.chat_id != hr.log_channel:
+        return
+    await hr.reply(event, "<pre>%s</pre>" % escape(hr.format_metrics()),
+                   parse_mode="html")
+
 def main():
-    hr.run(init=init_db)
+    create_app().run(init=init_bot, fini=fini_db)
 
 if __name__ == "__main__":
     main()
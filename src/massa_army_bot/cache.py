@@ -0,0 +1,182 @@
+import asyncio
+import time
+from collections import OrderedDict
+from functools import partial
+
+missing = object()
+
+# every named cache, for stats and update driven invalidation
+caches: dict[str, "TTLCache"] = {}
+
+class TTLCache:
+    def __init__(self, maxsize=1024, ttl=None, name=None, group=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        # group(key) names the entries invalidate_group drops together
+        self.group = group
+        self._data: OrderedDict = OrderedDict()
+        self._inflight: dict[object, asyncio.Task] = {}
+        self._groups: dict[object, set] = {}
+        self._invalidators: dict[type, list] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        if name is not None:
+            caches[name] = self
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, missing) is not missing
+
+    def __getitem__(self, key):
+        value = self.get(key, missing)
+        if value is missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def get(self, key, default=None):
+        try:
+            value, expires = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires is not None and expires <= time.monotonic():
+            del self._data[key]
+            self._unindex(key)
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=missing):
+        # a fetch running for this key must not overwrite the newer value
+        self._inflight.pop(key, None)
+        ttl = self.ttl if ttl is missing else ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        self._data[key] = value, expires
+        self._data.move_to_end(key)
+        self._index(key)
+        while len(self._data) > self.maxsize:
+            evicted, _ = self._data.popitem(last=False)
+            self._unindex(evicted)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        # a fetch running for this key must not store its stale result
+        self._inflight.pop(key, None)
+        value, _ = self._data.pop(key, (default, None))
+        self._unindex(key)
+        return value
+
+    def invalidate(self, pred):
+        for key in [k for k in (*self._data, *self._inflight) if pred(k)]:
+            self.pop(key)
+
+    def invalidate_group(self, group):
+        for key in self._groups.pop(group, ()):
+            self._inflight.pop(key, None)
+            self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+        self._inflight.clear()
+        self._groups.clear()
+
+    def _index(self, key):
+        if self.group is not None:
+            self._groups.setdefault(self.group(key), set()).add(key)
+
+    def _unindex(self, key):
+        # once the key is neither stored nor being fetched
+        if (self.group is None or key in self._data
+                or key in self._inflight):
+            return
+        group = self.group(key)
+        keys = self._groups.get(group)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._groups[group]
+
+    def invalidate_on(self, *update_types, key=None, pred=None, group=None):
+        # key(update) names the entry to drop, group(update) the group of
+        # entries, pred(update, key) selects entries by a scan, none of
+        # them drops everything
+        for update_type in update_types:
+            self._invalidators.setdefault(update_type, []).append(
+                (key, pred, group))
+
+    def on_update(self, update):
+        for update_type in type(update).__mro__:
+            for key, pred, group in self._invalidators.get(update_type, ()):
+                if key is not None:
+                    self.pop(key(update))
+                elif group is not None:
+                    self.invalidate_group(group(update))
+                elif pred is not None:
+                    self.invalidate(partial(pred, update))
+                else:
+                    self.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def _fetched(self, key, task):
+        if self._inflight.get(key) is not task:
+            return
+        del self._inflight[key]
+        if not task.cancelled() and task.exception() is None:
+            self.set(key, task.result())
+        else:
+            self._unindex(key)
+
+    async def get_or_fetch(self, key, fetch, *args, **kwargs):
+        # concurrent misses on the same key share a single fetch
+        value = self.get(key, missing)
+        if value is not missing:
+            return value
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fetch(*args, **kwargs))
+            self._inflight[key] = task
+            self._index(key)
+            task.add_done_callback(partial(self._fetched, key))
+        return await asyncio.shield(task)
+
+
+def invalidation_types():
+    return {update_type for cache in caches.values()
+            for update_type in cache._invalidators}
+
+def on_update(update):
+    for cache in caches.values():
+        cache.on_update(update)
+
+def format_stats():
+    lines = []
+    for name, cache in sorted(caches.items()):
+        stats = cache.stats()
+        lines.append(
+            "%s: %d/%d, hit rate %.1f%% of %d, %d evicted, %d expired" % (
+                name, stats["size"], stats["maxsize"],
+                stats["hit_rate"] * 100, stats["hits"] + stats["misses"],
+                stats["evictions"], stats["expirations"]))
+    return "\n".join(lines)
@@ -0,0 +1,346 @@
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import aiosqlite
+from telethon import utils
+
+from .cache import TTLCache
+from .metrics import waiting
+
+class Database:
+    def __init__(self, path: Path, readers=2, cached_statements=256,
+                 busy_timeout=5.):
+        self.path = path
+        self.nreaders = readers
+        self.cached_statements = cached_statements
+        # seconds a connection waits for another's lock to be released
+        self.busy_timeout = busy_timeout
+        self.writer: aiosqlite.Connection | None = None
+        self._readers: list[aiosqlite.Connection] = []
+        self._idle: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self._write_lock = asyncio.Lock()
+
+    async def _connect(self, readonly=False):
+        # sqlite3 keeps a per-connection cache of prepared statements,
+        # keyed on the sql text: long-lived connections reuse them
+        if readonly:
+            conn = await aiosqlite.connect(
+                "file:%s?mode=ro" % self.path.resolve(), uri=True,
+                cached_statements=self.cached_statements,
+                timeout=self.busy_timeout)
+        else:
+            conn = await aiosqlite.connect(
+                self.path, cached_statements=self.cached_statements,
+                timeout=self.busy_timeout)
+        return conn
+
+    async def open(self):
+        if self.writer is not None:
+            return
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.writer = await self._connect()
+        async with self.writer.execute("PRAGMA journal_mode = WAL") as cur:
+            row = await cur.fetchone()
+            assert row is not None
+            mode, = row
+            assert mode == 'wal', "Could not enable WAL mode..."
+        for _ in range(self.nreaders):
+            conn = await self._connect(readonly=True)
+            self._readers.append(conn)
+            self._idle.put_nowait(conn)
+
+    async def close(self):
+        async with self._write_lock:
+            for conn in self._readers:
+                await conn.close()
+            self._readers.clear()
+            self._idle = asyncio.Queue()
+            if self.writer is not None:
+                await self.writer.close()
+                self.writer = None
+
+    @asynccontextmanager
+    async def reader(self):
+        with waiting("db"):
+            conn = await self._idle.get()
+            try:
+                yield conn
+            finally:
+                self._idle.put_nowait(conn)
+
+    @asynccontextmanager
+    async def transaction(self):
+        assert self.writer is not None, "Database is not open"
+        with waiting("db"):
+            async with self._write_lock:
+                try:
+                    yield self.writer
+                except BaseException:
+                    await self.writer.rollback()
+                    raise
+                await self.writer.commit()
+
+    async def execute(self, sql, params=()):
+        async with self.transaction() as conn:
+            cur = await conn.execute(sql, params)
+            return cur.rowcount
+
+    async def executemany(self, sql, seq_of_params):
+        async with self.transaction() as conn:
+            await conn.executemany(sql, seq_of_params)
+
+    async def fetchone(self, sql, params=()):
+        async with self.reader() as conn:
+            async with conn.execute(sql, params) as cur:
+                return await cur.fetchone()
+
+    async def fetchall(self, sql, params=()):
+        async with self.reader() as conn:
+            async with conn.execute(sql, params) as cur:
+                return await cur.fetchall()
+
+msg_url_template = "https://t.me/c/%s/%s"
+
+def message_url(tg_msg_chat, tg_msg_id):
+    # private chats have no message links
+    if tg_msg_chat > 0:
+        return None
+    real_chat_id, _ = utils.resolve_id(tg_msg_chat)
+    return msg_url_template % (real_chat_id, tg_msg_id)
+
+insert_tw_user_sql = (
+    "INSERT INTO tw_users (tw_username) "
+    "VALUES (?) "
+    "ON CONFLICT DO NOTHING")
+
+insert_tw_post_sql = (
+    "INSERT INTO tw_posts ("
+    "tg_msg_chat, "
+    "tw_post_id, "
+    "tw_user_id, "
+    "tg_msg_by, "
+    "tg_msg_at, "
+    "tg_msg_id, "
+    "tg_msg_topic) "
+    "SELECT ?, ?, tw_user_id, ?, ?, ?, ? "
+    "FROM tw_users "
+    "WHERE tw_username = ? "
+    "ON CONFLICT (tg_msg_chat, tw_post_id) DO NOTHING")
+
+# history is read newest first, the oldest message keeps the post
+backfill_tw_post_sql = (
+    "INSERT INTO tw_posts ("
+    "tg_msg_chat, "
+    "tw_post_id, "
+    "tw_user_id, "
+    "tg_msg_by, "
+    "tg_msg_at, "
+    "tg_msg_id, "
+    "tg_msg_topic) "
+    "SELECT ?, ?, tw_user_id, ?, ?, ?, ? "
+    "FROM tw_users "
+    "WHERE tw_username = ? "
+    "ON CONFLICT (tg_msg_chat, tw_post_id) DO UPDATE SET "
+    "tw_user_id = excluded.tw_user_id, "
+    "tg_msg_by = excluded.tg_msg_by, "
+    "tg_msg_at = excluded.tg_msg_at, "
+    "tg_msg_id = excluded.tg_msg_id, "
+    "tg_msg_topic = excluded.tg_msg_topic "
+    "WHERE excluded.tg_msg_at < tw_posts.tg_msg_at")
+
+select_tw_post_sql = (
+    "SELECT "
+    "tw_username, "
+    "tw_post_id, "
+    "tg_msg_by, "
+    "tg_msg_at, "
+    "tg_msg_chat, "
+    "tg_msg_id, "
+    "tg_msg_topic "
+    "FROM tw_posts JOIN tw_users USING (tw_user_id) "
+    "WHERE tg_msg_chat = ? "
+    "AND tw_post_id = ?")
+
+# rows are (tw_username, tw_post_id, tg_msg_by, tg_msg_at,
+#           tg_msg_chat, tg_msg_id, tg_msg_topic, url)
+def post_params(row):
+    (tw_username, tw_post_id, tg_msg_by, tg_msg_at,
+     tg_msg_chat, tg_msg_id, tg_msg_topic, _) = row
+    return (tg_msg_chat, tw_post_id, tg_msg_by, tg_msg_at,
+            tg_msg_id, tg_msg_topic, tw_username)
+
+def stored_row(row):
+    if row is None:
+        return None
+    _, _, _, _, tg_msg_chat, tg_msg_id, _ = row
+    return (*row, message_url(tg_msg_chat, tg_msg_id))
+
+class TwPostsWriter:
+    def __init__(self, db: Database, max_batch=128, max_delay=.02):
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+        # usernames known to be interned already
+        self.users = TTLCache(maxsize=8192, name="tw_users")
+
+    async def intern_users(self, conn, rows):
+        # the caller marks them known once its transaction commits
+        users = {row[0] for row in rows if row[0] not in self.users}
+        if users:
+            await conn.executemany(insert_tw_user_sql,
+                                   [(tw_username,) for tw_username in users])
+        return users
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    async def insert(self, row):
+        # resolves to None once row is committed,
+        # or to the already stored row if it is a duplicate
+        assert self._task is not None, "TwPostsWriter is not started"
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((row, fut))
+        with waiting("db"):
+            return await fut
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            if self.max_delay and self._queue.qsize() < self.max_batch - 1:
+                await asyncio.sleep(self.max_delay)
+            while len(batch) < self.max_batch and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        results = []
+        try:
+            async with self.db.transaction() as conn:
+                users = await self.intern_users(conn,
+                                                [row for row, _ in batch])
+                for row, _ in batch:
+                    async with conn.execute(insert_tw_post_sql,
+                                            post_params(row)) as cur:
+                        inserted = cur.rowcount > 0
+                    if inserted:
+                        results.append(None)
+                        continue
+                    _, tw_post_id, _, _, tg_msg_chat, *_ = row
+                    async with conn.execute(
+                            select_tw_post_sql,
+                            (tg_msg_chat, tw_post_id)) as cur:
+                        results.append(stored_row(await cur.fetchone()))
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for tw_username in users:
+            self.users[tw_username] = True
+        for (_, fut), result in zip(batch, results):
+            if not fut.done():
+                fut.set_result(result)
+
+class TwPostsIndex:
+    def __init__(self, db: Database, writer: TwPostsWriter, lru_size=4096):
+        self.db = db
+        self.writer = writer
+        self.lru_size = lru_size
+        # per chat ids of the posts already stored
+        self._seen: dict[int, set[int]] = {}
+        self._rows: OrderedDict[tuple, tuple] = OrderedDict()
+
+    def start(self):
+        self.writer.start()
+
+    async def stop(self):
+        await self.writer.stop()
+
+    async def warm(self, shard=None):
+        # shard is (index, count), to only load the chats a worker owns
+        sql, params = "SELECT tg_msg_chat, tw_post_id FROM tw_posts", ()
+        if shard is not None:
+            sql += " WHERE abs(tg_msg_chat) % ? = ?"
+            params = (shard[1], shard[0])
+        seen = {}
+        async with self.db.reader() as conn:
+            async with conn.execute(sql, params) as cur:
+                async for tg_msg_chat, tw_post_id in cur:
+                    seen.setdefault(tg_msg_chat, set()).add(tw_post_id)
+        self._seen = seen
+
+    def _remember(self, key, row):
+        tg_msg_chat, tw_post_id = key
+        self._seen.setdefault(tg_msg_chat, set()).add(tw_post_id)
+        self._rows[key] = row
+        self._rows.move_to_end(key)
+        if len(self._rows) > self.lru_size:
+            self._rows.popitem(last=False)
+
+    async def lookup(self, tg_msg_chat, tw_post_id):
+        key = (tg_msg_chat, int(tw_post_id))
+        row = self._rows.get(key)
+        if row is not None:
+            self._rows.move_to_end(key)
+            return row
+        seen = self._seen.get(tg_msg_chat)
+        if not seen or key[1] not in seen:
+            return None
+        row = stored_row(await self.db.fetchone(select_tw_post_sql, key))
+        if row is not None:
+            self._remember(key, row)
+        return row
+
+    def forget(self, tg_msg_chat, post_ids):
+        seen = self._seen.get(tg_msg_chat, set())
+        for tw_post_id in post_ids:
+            seen.discard(tw_post_id)
+            self._rows.pop((tg_msg_chat, tw_post_id), None)
+
+    async def backfill(self, rows, cursor=None):
+        # cursor is an extra (sql, params) committed along with the rows
+        rows = [(tw_username, int(tw_post_id), *rest)
+                for tw_username, tw_post_id, *rest in rows]
+        async with self.db.transaction() as conn:
+            users = await self.writer.intern_users(conn, rows)
+            await conn.executemany(backfill_tw_post_sql,
+                                   map(post_params, rows))
+            if cursor is not None:
+                await conn.execute(*cursor)
+        for tw_username in users:
+            self.writer.users[tw_username] = True
+        for _, tw_post_id, _, _, tg_msg_chat, *_ in rows:
+            self._seen.setdefault(tg_msg_chat, set()).add(tw_post_id)
+            # an older message may have taken over the post
+            self._rows.pop((tg_msg_chat, tw_post_id), None)
+
+    async def insert(self, row):
+        tw_username, tw_post_id, _, _, tg_msg_chat, *_ = row
+        row = (tw_username, int(tw_post_id), *row[2:])
+        key = (tg_msg_chat, int(tw_post_id))
+        dup = await self.lookup(*key)
+        if dup is not None:
+            return dup
+        dup = await self.writer.insert(row)
+        self._remember(key, row if dup is None else dup)
+        return dup
@@ -0,0 +1,180 @@
+import asyncio
+import re
+from collections import defaultdict
+from collections import deque
+from html import escape
+
+from telethon import utils
+
+from .links import has_more_text
+from .metrics import waiting
+
+twitter_url_pattern = re.compile(
+    "<a href=\"(?P<href>"
+    r"(?:https?://)?(?:x|twitter).com?/"
+    r"(?P<tw_username>[^/]*)/status/"
+    r"(?P<tw_post_id>\d+)([/?]?\S*)?"
+    ")\">(?:.*?(?=</a>))</a>",
+    re.MULTILINE | re.DOTALL | re.IGNORECASE
+)
+
+parse_mode = utils.sanitize_parse_mode("html")
+def unparse(raw_text, entities):
+    return parse_mode.unparse(raw_text, entities)  # type: ignore
+
+link_template = '<a href="%s">%s</a>'
+dup_template = link_template % ('%s', 'Marked as duplicate')
+tw_url_template = "https://x.com/%s/status/%s"
+
+class WorkItem:
+    # a message on its way through dedup, filled in by its stages in
+    # turn so that a repost or a retry picks up their results instead
+    # of running them again. plain values only, it is pickled to the
+    # workers:
+    #   extract: raw_text, entities, is_private, links, html once needed
+    #   classify: raid_topic, then chat_id, msg_id, sender_id, date,
+    #     topic_id, url as in tw_posts
+    #   persist: dup_rows, the stored rows of the links already known,
+    #     and the actions to answer with
+    #   respond: title once rendered, how many actions were sent
+    #   username: the bot's, stripped along with ignore_prefix
+    #   ignore_duplicate, ignore_prefix, skip_repost: the dedup() flags
+    __slots__ = (
+        "raw_text", "entities", "is_private", "links", "html",
+        "raid_topic", "chat_id", "msg_id", "sender_id", "date",
+        "topic_id", "url",
+        "dup_rows", "actions", "title", "sent",
+        "username", "ignore_duplicate", "ignore_prefix", "skip_repost",
+    )
+
+    def __init__(self, raw_text: str, entities, is_private: bool,
+                 links: list, username: str, ignore_duplicate=False,
+                 ignore_prefix: str | None = None, skip_repost=False):
+        self.raw_text = raw_text
+        self.entities = entities
+        self.is_private = is_private
+        self.links = links
+        self.html: str | None = None
+        self.raid_topic: int | None = None
+        self.chat_id: int | None = None
+        self.msg_id: int | None = None
+        self.sender_id: int | None = None
+        self.date: int | None = None
+        self.topic_id: int | None = None
+        self.url: str | None = None
+        self.dup_rows: list | None = None
+        self.actions: list | None = None
+        self.title: str | None = None
+        self.sent = 0
+        self.username = username
+        self.ignore_duplicate = ignore_duplicate
+        self.ignore_prefix = ignore_prefix
+        self.skip_repost = skip_repost
+
+def item_html(item):
+    if item.html is None:
+        item.html = unparse(item.raw_text, item.entities)
+    return item.html
+
+async def item_title(item, get_title):
+    # rendered by the process owning the client, a worker is handed it
+    if item.title is None:
+        item.title = await get_title()
+    return item.title
+
+async def render_response(item, get_title):
+    text = item_html(item)
+    ignore_prefix = item.ignore_prefix
+    if ignore_prefix:
+        text = text.lstrip(ignore_prefix).lstrip(
+            "@%s" % item.username).strip()
+    # stored rows of the duplicate links, in message order
+    pending = defaultdict(deque)
+    for key, row in item.dup_rows:
+        pending[key].append(row)
+    response_ok = []
+    response_duplicate = []
+    last_end, end = 0, 0
+    for m in twitter_url_pattern.finditer(text):
+        start, end = m.span()
+        more_text = text[last_end:start]
+        rows = pending.get(int(m["tw_post_id"]))
+        row = rows.popleft() if rows else None
+        if row is None or item.ignore_duplicate:
+            response_ok.append(text[last_end:end])
+        else:
+            (tw_username, tw_post_id,
+             _, _, _, _, _,
+             dup_url) = row
+            if item.is_private:
+                response_ok.append("%s%s" % (
+                    more_text,
+                    dup_template % escape(
+                        tw_url_template % (
+                            tw_username,
+                            tw_post_id))))
+            else:
+                response_ok.append("%s%s" % (
+                    more_text,
+                    dup_template % escape(dup_url)))
+        if row is not None:
+            response_duplicate.append(text[start:end])
+        last_end = end
+    response = "".join((*response_ok, text[end:]))
+    response = "\n".join((await item_title(item, get_title), response))
+    return response, response_duplicate
+
+async def persist(item, tw_posts):
+    # once per item, a retry finds the rows of the first run
+    if item.dup_rows is not None:
+        return item.dup_rows
+    links = item.links
+    # submit every post of the message at once so they share a commit,
+    # and time the wait once rather than per insert
+    with waiting("db"):
+        rows = await asyncio.gather(*(
+            tw_posts.insert((link.tw_username, link.tw_post_id,
+                             item.sender_id, item.date,
+                             item.chat_id, item.msg_id,
+                             item.topic_id, item.url))
+            for link in links))
+    item.dup_rows = [(link.tw_post_id, row)
+                     for link, row in zip(links, rows) if row is not None]
+    return item.dup_rows
+
+async def plan_response(item, get_title):
+    # what to send about the stored posts of item:
+    #   ("reply", html): answer the message, as a repost
+    #   ("notice", [html]): list its duplicate links, then self-destruct
+    #   ("repost", html): copy it to the raid topic
+    dup_rows = item.dup_rows
+    if item.skip_repost:
+        return []
+    ignore_duplicate = item.ignore_duplicate
+    if item.topic_id == item.raid_topic:
+        if not dup_rows:
+            return []
+        ignore_prefix = item.ignore_prefix
+        more_text = has_more_text(
+            item.raw_text, item.links,
+            lstrip=(ignore_prefix, "@%s" % item.username) if ignore_prefix
+            else ())
+        response, response_duplicate = await render_response(
+            item, get_title)
+        actions = []
+        if more_text or ignore_duplicate:
+            actions.append(("reply", response))
+        if not ignore_duplicate:
+            actions.append(("notice", [r.strip() for r in response_duplicate]))
+        return actions
+    if not dup_rows or ignore_duplicate:
+        response, _ = await render_response(item, get_title)
+        return [("repost", response)]
+    return []
+
+async def plan_dedup(item, tw_posts, get_title):
+    # stores the posts of item and returns the actions to answer with
+    if item.actions is None:
+        await persist(item, tw_posts)
+        item.actions = await plan_response(item, get_title)
+    return item.actions
@@ -0,0 +1,94 @@
+import asyncio
+from collections import Counter
+from collections import deque
+from collections import OrderedDict
+
+class Dispatcher:
+    # starts handlers in arrival order within a chat, a bounded number
+    # at once overall, round robin over the chats with pending work.
+    # a few run at once per chat so that their db writes still batch
+    def __init__(self, max_running=32, per_chat=8, shed_depth=256):
+        self.max_running = max_running
+        self.per_chat = per_chat
+        self.shed_depth = shed_depth
+        self.running = 0
+        self.depth = 0
+        self.shed = Counter()
+        self._busy: Counter = Counter()
+        self._waiting: OrderedDict[object, deque] = OrderedDict()
+
+    @property
+    def overloaded(self):
+        return self.depth >= self.shed_depth
+
+    def should_shed(self, what):
+        # optional work, e.g. log mirrors, is dropped under load
+        if not self.overloaded:
+            return False
+        self.shed[what] += 1
+        return True
+
+    def _free(self, key):
+        return (self.running < self.max_running
+                and self._busy[key] < self.per_chat)
+
+    def _take(self, key):
+        self.running += 1
+        self._busy[key] += 1
+
+    def release(self, key):
+        self.running -= 1
+        self._busy[key] -= 1
+        if not self._busy[key]:
+            del self._busy[key]
+        self._wake()
+
+    def _wake(self):
+        while self.running < self.max_running:
+            for key, chat_queue in self._waiting.items():
+                if self._busy[key] < self.per_chat:
+                    break
+            else:
+                return
+            fut = chat_queue.popleft()
+            self.depth -= 1
+            if chat_queue:
+                self._waiting.move_to_end(key)
+            else:
+                del self._waiting[key]
+            if fut.done():
+                # cancelled, its task is yet to step out of acquire
+                continue
+            self._take(key)
+            fut.set_result(None)
+
+    async def acquire(self, key):
+        if key not in self._waiting and self._free(key):
+            self._take(key)
+            return
+        fut = asyncio.get_running_loop().create_future()
+        chat_queue = self._waiting.get(key)
+        if chat_queue is None:
+            chat_queue = self._waiting[key] = deque()
+        chat_queue.append(fut)
+        self.depth += 1
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # granted right as we got cancelled
+                self.release(key)
+            elif fut in chat_queue:
+                # else _wake dropped it already
+                chat_queue.remove(fut)
+                self.depth -= 1
+                if not chat_queue and self._waiting.get(key) is chat_queue:
+                    del self._waiting[key]
+            raise
+
+    def format(self):
+        return "Dispatcher: %d running, %d queued in %d chats%s" % (
+            self.running, self.depth, len(self._waiting),
+            ", shed %s" % ", ".join("%s %d" % item
+                                    for item in self.shed.most_common())
+            if self.shed else "")
@@ -0,0 +1,60 @@
+import re
+from typing import NamedTuple
+
+from telethon import types
+
+status_url_pattern = re.compile(
+    r"(?:https?://)?(?:x|twitter)\.com?/"
+    r"(?P<tw_username>[^/]*)/status/"
+    r"(?P<tw_post_id>\d+)",
+    re.IGNORECASE
+)
+# entity offsets count utf-16 code units
+utf16 = "utf-16-le"
+
+class TwLink(NamedTuple):
+    tw_username: str
+    tw_post_id: int
+    # offsets in the message text, as in its entities
+    start: int
+    end: int
+    url: str
+
+def parse_status_url(url: str):
+    m = status_url_pattern.match(url)
+    if m is None:
+        return None
+    return m["tw_username"], int(m["tw_post_id"])
+
+def extract_links(raw_text: str, entities) -> list[TwLink]:
+    if not entities:
+        return []
+    links = []
+    text = None
+    for entity in entities:
+        if isinstance(entity, types.MessageEntityTextUrl):
+            url = entity.url
+        elif isinstance(entity, types.MessageEntityUrl):
+            if text is None:
+                text = raw_text.encode(utf16)
+            url = text[entity.offset * 2:
+                       (entity.offset + entity.length) * 2].decode(utf16)
+        else:
+            continue
+        parsed = parse_status_url(url)
+        if parsed is not None:
+            links.append(TwLink(*parsed, entity.offset,
+                                entity.offset + entity.length, url))
+    return links
+
+def has_more_text(raw_text: str, links: list[TwLink], lstrip=()):
+    body = raw_text
+    for chars in lstrip:
+        body = body.lstrip(chars)
+    text = raw_text.encode(utf16)
+    pos = len(text) - len(body.encode(utf16))
+    for link in links:
+        if text[pos:link.start * 2].decode(utf16).strip():
+            return True
+        pos = max(pos, link.end * 2)
+    return bool(text[pos:].decode(utf16).strip())
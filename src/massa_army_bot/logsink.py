@@ -0,0 +1,87 @@
+import asyncio
+from traceback import format_exc
+
+# telegram's limit, counted on the parsed text: html is always longer
+max_message_len = 4096
+
+class LogSink:
+    def __init__(self, send, maxsize=1000, flush_delay=1.,
+                 max_len=max_message_len, sep="\n\n"):
+        self.send = send
+        self.flush_delay = flush_delay
+        self.max_len = max_len
+        self.sep = sep
+        self.dropped = 0
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    def put(self, text, file=None, **kwargs):
+        try:
+            self._queue.put_nowait((text, file, kwargs))
+            return True
+        except asyncio.QueueFull:
+            # the entry was already printed locally
+            self.dropped += 1
+            return False
+
+    def _batch(self, entries):
+        # merge plain entries into as few messages as possible,
+        # entries with a file or extra send options go on their own
+        chunk = []
+        size = 0
+        for text, file, kwargs in entries:
+            if file is not None or kwargs or len(text) > self.max_len:
+                if chunk:
+                    yield self.sep.join(chunk), None, {}
+                    chunk, size = [], 0
+                yield text, file, kwargs
+                continue
+            added = len(text) + (len(self.sep) if chunk else 0)
+            if chunk and size + added > self.max_len:
+                yield self.sep.join(chunk), None, {}
+                chunk, size = [], 0
+                added = len(text)
+            chunk.append(text)
+            size += added
+        if chunk:
+            yield self.sep.join(chunk), None, {}
+
+    async def _send(self, text, file, kwargs):
+        # flood waits are retried by the outbox behind send
+        try:
+            return await self.send(text, file=file, **kwargs)
+        except Exception:
+            print("Could not send log entry:\n%s" % format_exc())
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            entry = await self._queue.get()
+            if entry is None:
+                break
+            entries = [entry]
+            if self.flush_delay:
+                await asyncio.sleep(self.flush_delay)
+            while not self._queue.empty():
+                entry = self._queue.get_nowait()
+                if entry is None:
+                    stopping = True
+                    break
+                entries.append(entry)
+            if self.dropped:
+                entries.append((
+                    "<i>%s log entries dropped</i>" % self.dropped, None, {}))
+                self.dropped = 0
+            for text, file, kwargs in self._batch(entries):
+                await self._send(text, file, kwargs)
@@ -0,0 +1,189 @@
+import asyncio
+import time
+from pathlib import Path
+
+from .db import Database
+from .db import TwPostsIndex
+
+archive_schema = (
+    "CREATE TABLE IF NOT EXISTS archive.tw_posts ("
+    "tg_msg_chat INTEGER NOT NULL, "
+    "tw_post_id INTEGER NOT NULL, "
+    "tw_username TEXT NOT NULL, "
+    "tg_msg_by INTEGER NOT NULL, "
+    "tg_msg_at INTEGER NOT NULL, "
+    "tg_msg_id INTEGER NOT NULL, "
+    "tg_msg_topic INTEGER, "
+    "PRIMARY KEY (tg_msg_chat, tw_post_id)"
+    ") WITHOUT ROWID",
+)
+
+archive_tw_posts_sql = (
+    "INSERT INTO archive.tw_posts "
+    "SELECT tg_msg_chat, tw_post_id, tw_username, "
+    "tg_msg_by, tg_msg_at, tg_msg_id, tg_msg_topic "
+    "FROM main.tw_posts JOIN main.tw_users USING (tw_user_id) "
+    "WHERE tg_msg_chat = ? AND tw_post_id = ? "
+    "ON CONFLICT DO NOTHING")
+
+class Maintenance:
+    # prunes posts past their chat's retention into an archive database,
+    # checkpoints the wal and vacuums when no handler is running
+    def __init__(self, db: Database, index: TwPostsIndex, archive: Path,
+                 retention_days=30, interval=15 * 60, batch=1000,
+                 vacuum_pages=1000):
+        self.db = db
+        self.index = index
+        self.archive = archive
+        self.retention_days = retention_days
+        self.interval = interval
+        self.batch = batch
+        self.vacuum_pages = vacuum_pages
+        self.is_quiet = lambda: True
+        # called with each chat's pruned post ids, for the other indexes
+        self.on_prune = []
+        self.archived = 0
+        self.checkpoints = 0
+        self.vacuumed_pages = 0
+        self.rebuild = False
+        self.rebuilds = 0
+        self.last_run = None
+        self._task: asyncio.Task | None = None
+
+    async def start(self, is_quiet=None):
+        if is_quiet is not None:
+            self.is_quiet = is_quiet
+        async with self.db.transaction() as conn:
+            async with conn.execute("PRAGMA auto_vacuum") as cur:
+                auto_vacuum, = await cur.fetchone()
+            # databases from before incremental vacuum are rebuilt
+            # by the first quiet run, not while the bot starts
+            self.rebuild = auto_vacuum != 2
+            await conn.execute(
+                "ATTACH DATABASE ? AS archive", (str(self.archive),))
+        async with self.db.transaction() as conn:
+            for sql in archive_schema:
+                await conn.execute(sql)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            ...
+        self._task = None
+        async with self.db.transaction() as conn:
+            await conn.execute("DETACH DATABASE archive")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.run()
+
+    async def run(self):
+        await self.prune()
+        while not self.is_quiet():
+            await asyncio.sleep(1)
+        if self.rebuild:
+            await self.rebuild_db()
+        await self.vacuum()
+        await self.checkpoint()
+        self.last_run = time.time()
+
+    async def retentions(self):
+        # chats with posts and the oldest tg_msg_at they keep
+        now = int(time.time())
+        rows = await self.db.fetchall(
+            "SELECT chats.tg_msg_chat, retention.days "
+            "FROM (SELECT DISTINCT tg_msg_chat FROM tw_posts) AS chats "
+            "LEFT JOIN retention ON retention.chat_id = chats.tg_msg_chat")
+        for tg_msg_chat, days in rows:
+            days = self.retention_days if days is None else days
+            if days:
+                yield tg_msg_chat, now - days * 24 * 60 * 60
+
+    async def prune(self):
+        async for tg_msg_chat, oldest in self.retentions():
+            while True:
+                post_ids = [post_id for post_id, in await self.db.fetchall(
+                    "SELECT tw_post_id FROM tw_posts "
+                    "WHERE tg_msg_chat = ? AND tg_msg_at < ? "
+                    "LIMIT ?", (tg_msg_chat, oldest, self.batch))]
+                if not post_ids:
+                    break
+                keys = [(tg_msg_chat, post_id) for post_id in post_ids]
+                # the main database is in wal mode, so a transaction
+                # spanning both files isn't atomic: copy, then delete
+                async with self.db.transaction() as conn:
+                    await conn.executemany(archive_tw_posts_sql, keys)
+                async with self.db.transaction() as conn:
+                    await conn.executemany(
+                        "DELETE FROM tw_posts "
+                        "WHERE tg_msg_chat = ? AND tw_post_id = ?", keys)
+                self.index.forget(tg_msg_chat, post_ids)
+                for forget in self.on_prune:
+                    forget(tg_msg_chat, post_ids)
+                self.archived += len(post_ids)
+                if len(post_ids) < self.batch:
+                    break
+
+    async def checkpoint(self):
+        async with self.db.transaction() as conn:
+            async with conn.execute(
+                    "PRAGMA main.wal_checkpoint(TRUNCATE)") as cur:
+                busy, _, _ = await cur.fetchone()
+        if not busy:
+            self.checkpoints += 1
+
+    async def rebuild_db(self):
+        # a full VACUUM holds the writer for as long as it copies the
+        # database, incremental vacuum only takes effect after one
+        async with self.db.transaction() as conn:
+            await conn.execute("PRAGMA main.auto_vacuum = INCREMENTAL")
+            await conn.execute("VACUUM main")
+        self.rebuild = False
+        self.rebuilds += 1
+
+    async def freelist_count(self, conn):
+        async with conn.execute("PRAGMA main.freelist_count") as cur:
+            free, = await cur.fetchone()
+        return free
+
+    async def vacuum(self):
+        while self.is_quiet():
+            async with self.db.transaction() as conn:
+                free = await self.freelist_count(conn)
+                if not free:
+                    return
+                # each step of the pragma frees one page, sqlite3's
+                # execute() only takes the first
+                async with conn.execute(
+                        "PRAGMA main.incremental_vacuum(%d)"
+                        % min(free, self.vacuum_pages)) as cur:
+                    await cur.fetchall()
+                freed = free - await self.freelist_count(conn)
+            self.vacuumed_pages += freed
+            if not freed:
+                return
+            await asyncio.sleep(0)
+
+    def sizes(self):
+        path = self.db.path
+        return {name: file.stat().st_size if file.exists() else 0
+                for name, file in (
+                    ("db", path),
+                    ("wal", path.with_name(path.name + "-wal")),
+                    ("archive", self.archive))}
+
+    def format(self):
+        sizes = self.sizes()
+        return ("Database: %.1f MiB, wal %.1f MiB, archive %.1f MiB, "
+                "%d posts archived, %d checkpoints, %d pages vacuumed, "
+                "%d rebuilds%s" % (
+                    sizes["db"] / 2**20, sizes["wal"] / 2**20,
+                    sizes["archive"] / 2**20, self.archived,
+                    self.checkpoints, self.vacuumed_pages, self.rebuilds,
+                    ", rebuild pending" if self.rebuild else ""))
@@ -0,0 +1,117 @@
+import bisect
+import time
+from contextvars import ContextVar
+
+# upper bounds of the latency buckets, in seconds
+buckets = (.001, .002, .005, .01, .02, .05, .1, .2, .5,
+           1., 2., 5., 10., 30., 60., float("inf"))
+
+class Histogram:
+    def __init__(self, bounds=buckets):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return 0.
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.bounds[-1]
+
+class HandlerStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.latency = Histogram()
+        self.lag = Histogram()
+        # time spent waiting, by kind of wait: rpc, db
+        self.waits: dict[str, float] = {}
+
+class Metrics:
+    def __init__(self):
+        self.handlers: dict[str, HandlerStats] = {}
+        self.since = time.time()
+
+    def stats(self, name):
+        stats = self.handlers.get(name)
+        if stats is None:
+            stats = self.handlers[name] = HandlerStats()
+        return stats
+
+    def reset(self):
+        self.handlers.clear()
+        self.since = time.time()
+
+    def format(self):
+        lines = ["Handler metrics over the last %ds" % (
+            time.time() - self.since)]
+        handlers = sorted(self.handlers.items(),
+                          key=lambda item: -item[1].latency.sum)
+        for name, stats in handlers:
+            latency, lag = stats.latency, stats.lag
+            line = "%s: %d calls, %d errors, p50 %s p99 %s max %s" % (
+                name, stats.calls, stats.errors,
+                format_seconds(latency.quantile(.5)),
+                format_seconds(latency.quantile(.99)),
+                format_seconds(latency.quantile(1.)))
+            if stats.waits and latency.sum:
+                line += ", waiting on %s" % ", ".join(
+                    "%s %.0f%%" % (kind, 100 * waited / latency.sum)
+                    for kind, waited in sorted(stats.waits.items()))
+            if lag.count:
+                line += ", lag p50 %s p99 %s" % (
+                    format_seconds(lag.quantile(.5)),
+                    format_seconds(lag.quantile(.99)))
+            lines.append(line)
+        return "\n".join(lines)
+
+def format_seconds(seconds):
+    if seconds == float("inf"):
+        return ">%gs" % buckets[-2]
+    if seconds < 1:
+        return "%gms" % (seconds * 1000)
+    return "%gs" % seconds
+
+# stats of the handler running in the current task, if any
+current: ContextVar[HandlerStats | None] = ContextVar(
+    "current", default=None)
+_waiting: ContextVar[bool] = ContextVar("_waiting", default=False)
+
+class waiting:
+    # charges the time spent in the block to the current handler,
+    # nested blocks count once, for the outermost kind
+    __slots__ = ("kind", "stats", "start", "token")
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.stats = None
+
+    def __enter__(self):
+        stats = current.get()
+        if stats is None or _waiting.get():
+            return self
+        self.stats = stats
+        self.token = _waiting.set(True)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        stats = self.stats
+        if stats is None:
+            return
+        self.stats = None
+        _waiting.reset(self.token)
+        stats.waits[self.kind] = (stats.waits.get(self.kind, 0.)
+                                  + time.perf_counter() - self.start)
@@ -0,0 +1,212 @@
+# schema migrations, applied in order, each one in its own transaction.
+# a migration's statements are sql, or checks called with the connection.
+# PRAGMA user_version counts the migrations a database has gone through:
+# only append to this list, never edit a migration that shipped
+
+# the schema init_db used to create, all of it idempotent so that
+# databases from before migrations go through it unharmed
+initial = (
+    "CREATE TABLE IF NOT EXISTS tw_posts ("
+    "tw_username TEXT NOT NULL, "
+    "tw_post_id INTEGER NOT NULL, "
+    "tg_msg_by INTEGER NOT NULL, "
+    "tg_msg_at INTEGER NOT NULL, "
+    "tg_msg_chat INTEGER NOT NULL, "
+    "tg_msg_id INTEGER NOT NULL, "
+    "tg_msg_topic INTEGER, "
+    "url TEXT)",
+
+    "CREATE TABLE IF NOT EXISTS topics ("
+    "topic_chat INTEGER NOT NULL, "
+    "topic_id INTEGER NOT NULL, "
+    "topic_name TEXT NOT NULL)",
+
+    "CREATE TABLE IF NOT EXISTS raid_topics ("
+    "topic_chat INTEGER NOT NULL UNIQUE, "
+    "topic_id INTEGER NOT NULL, "
+    "FOREIGN KEY (topic_chat) "
+    "REFERENCES topics (topic_chat), "
+    "FOREIGN KEY (topic_id) "
+    "REFERENCES topics (topic_id))",
+
+    "CREATE TABLE IF NOT EXISTS linked_chats ("
+    "linked_chat_id INTEGER NOT NULL, "
+    "chat_id INTEGER NOT NULL, "
+    "FOREIGN KEY (chat_id) "
+    "REFERENCES topics (topic_chat),"
+    "UNIQUE (chat_id, linked_chat_id))",
+
+    "CREATE TABLE IF NOT EXISTS pending_deletions ("
+    "chat_id INTEGER NOT NULL, "
+    "msg_id INTEGER NOT NULL, "
+    "deadline REAL NOT NULL, "
+    "UNIQUE (chat_id, msg_id))",
+
+    "CREATE TABLE IF NOT EXISTS backfills ("
+    "chat_id INTEGER PRIMARY KEY, "
+    "topic_id INTEGER NOT NULL, "
+    "next_id INTEGER NOT NULL, "
+    "posts INTEGER NOT NULL)",
+
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_tw_posts "
+    "ON tw_posts (tw_username, tw_post_id, tg_msg_chat)",
+
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_topics "
+    "ON topics (topic_chat, topic_id)",
+
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_linked_chats "
+    "ON linked_chats (chat_id, linked_chat_id)",
+)
+
+async def check_compacted(conn):
+    # every post is kept, once per chat
+    async with conn.execute(
+            "SELECT (SELECT count(*) FROM tw_posts_compact), "
+            "(SELECT count(*) FROM (SELECT DISTINCT tg_msg_chat, tw_post_id "
+            "FROM tw_posts))") as cur:
+        compacted, posts = await cur.fetchone()
+    if compacted != posts:
+        raise RuntimeError("compacted %d of %d posts" % (compacted, posts))
+
+# post ids are unique across twitter: a post is keyed on its chat and
+# id alone, clustered on that key, and usernames are stored once.
+# message urls are derived from the chat and message ids
+compact_tw_posts = (
+    "CREATE TABLE tw_users ("
+    "tw_user_id INTEGER PRIMARY KEY, "
+    "tw_username TEXT NOT NULL UNIQUE COLLATE NOCASE)",
+
+    "INSERT INTO tw_users (tw_username) "
+    "SELECT tw_username FROM tw_posts "
+    "ORDER BY tg_msg_at "
+    "ON CONFLICT DO NOTHING",
+
+    "CREATE TABLE tw_posts_compact ("
+    "tg_msg_chat INTEGER NOT NULL, "
+    "tw_post_id INTEGER NOT NULL, "
+    "tw_user_id INTEGER NOT NULL REFERENCES tw_users, "
+    "tg_msg_by INTEGER NOT NULL, "
+    "tg_msg_at INTEGER NOT NULL, "
+    "tg_msg_id INTEGER NOT NULL, "
+    "tg_msg_topic INTEGER, "
+    "PRIMARY KEY (tg_msg_chat, tw_post_id)"
+    ") WITHOUT ROWID",
+
+    # the same post under another username case counts once,
+    # for its oldest message. the first bots stored the message and
+    # topic ids swapped, the url alone has the message id right: its
+    # trailing digits
+    "INSERT INTO tw_posts_compact "
+    "SELECT tg_msg_chat, tw_post_id, tw_user_id, "
+    "tg_msg_by, tg_msg_at, coalesce(url_id, tg_msg_id), "
+    "CASE WHEN url_id = tg_msg_topic AND url_id != tg_msg_id "
+    "THEN tg_msg_id ELSE tg_msg_topic END "
+    "FROM (SELECT *, CAST(nullif(replace(url, rtrim(url, '0123456789'), "
+    "''), '') AS INTEGER) AS url_id FROM tw_posts) AS t "
+    # the username under its interned case
+    "JOIN tw_users ON tw_users.tw_username = t.tw_username COLLATE NOCASE "
+    "ORDER BY tg_msg_at "
+    "ON CONFLICT DO NOTHING",
+
+    check_compacted,
+
+    "DROP TABLE tw_posts",
+
+    "ALTER TABLE tw_posts_compact RENAME TO tw_posts",
+)
+
+# days a chat's posts count as duplicates, the default when absent
+retention = (
+    "CREATE TABLE retention ("
+    "chat_id INTEGER PRIMARY KEY, "
+    "days INTEGER NOT NULL)",
+)
+
+# posts per utc day, and per sharer, kept by triggers in the transaction
+# of the tw_posts write. pruned posts stay counted, backfilled ones move
+# to the day of their older message. chats without topics are topic 0
+raid_stats = (
+    "CREATE INDEX idx_tw_posts_at ON tw_posts (tg_msg_chat, tg_msg_at)",
+
+    "CREATE TABLE daily_posts ("
+    "tg_msg_chat INTEGER NOT NULL, "
+    "tg_msg_topic INTEGER NOT NULL, "
+    "day INTEGER NOT NULL, "
+    "posts INTEGER NOT NULL, "
+    "PRIMARY KEY (tg_msg_chat, tg_msg_topic, day)"
+    ") WITHOUT ROWID",
+
+    "CREATE TABLE daily_sharers ("
+    "tg_msg_chat INTEGER NOT NULL, "
+    "tg_msg_topic INTEGER NOT NULL, "
+    "day INTEGER NOT NULL, "
+    "tg_msg_by INTEGER NOT NULL, "
+    "posts INTEGER NOT NULL, "
+    "PRIMARY KEY (tg_msg_chat, tg_msg_topic, day, tg_msg_by)"
+    ") WITHOUT ROWID",
+
+    "INSERT INTO daily_posts "
+    "SELECT tg_msg_chat, coalesce(tg_msg_topic, 0), tg_msg_at / 86400, "
+    "count(*) FROM tw_posts GROUP BY 1, 2, 3",
+
+    "INSERT INTO daily_sharers "
+    "SELECT tg_msg_chat, coalesce(tg_msg_topic, 0), tg_msg_at / 86400, "
+    "tg_msg_by, count(*) FROM tw_posts GROUP BY 1, 2, 3, 4",
+
+    "CREATE TRIGGER tw_posts_count AFTER INSERT ON tw_posts BEGIN "
+    "INSERT INTO daily_posts VALUES ("
+    "new.tg_msg_chat, coalesce(new.tg_msg_topic, 0), "
+    "new.tg_msg_at / 86400, 1) "
+    "ON CONFLICT DO UPDATE SET posts = posts + 1; "
+    "INSERT INTO daily_sharers VALUES ("
+    "new.tg_msg_chat, coalesce(new.tg_msg_topic, 0), "
+    "new.tg_msg_at / 86400, new.tg_msg_by, 1) "
+    "ON CONFLICT DO UPDATE SET posts = posts + 1; "
+    "END",
+
+    "CREATE TRIGGER tw_posts_recount "
+    "AFTER UPDATE OF tg_msg_by, tg_msg_at, tg_msg_topic ON tw_posts BEGIN "
+    "UPDATE daily_posts SET posts = posts - 1 "
+    "WHERE tg_msg_chat = old.tg_msg_chat "
+    "AND tg_msg_topic = coalesce(old.tg_msg_topic, 0) "
+    "AND day = old.tg_msg_at / 86400; "
+    "UPDATE daily_sharers SET posts = posts - 1 "
+    "WHERE tg_msg_chat = old.tg_msg_chat "
+    "AND tg_msg_topic = coalesce(old.tg_msg_topic, 0) "
+    "AND day = old.tg_msg_at / 86400 "
+    "AND tg_msg_by = old.tg_msg_by; "
+    "INSERT INTO daily_posts VALUES ("
+    "new.tg_msg_chat, coalesce(new.tg_msg_topic, 0), "
+    "new.tg_msg_at / 86400, 1) "
+    "ON CONFLICT DO UPDATE SET posts = posts + 1; "
+    "INSERT INTO daily_sharers VALUES ("
+    "new.tg_msg_chat, coalesce(new.tg_msg_topic, 0), "
+    "new.tg_msg_at / 86400, new.tg_msg_by, 1) "
+    "ON CONFLICT DO UPDATE SET posts = posts + 1; "
+    "END",
+)
+
+migrations = (
+    initial,
+    compact_tw_posts,
+    retention,
+    raid_stats,
+)
+
+def pending(version):
+    return list(enumerate(migrations[version:], version + 1))
+
+async def migrate(db):
+    async with db.transaction() as conn:
+        async with conn.execute("PRAGMA user_version") as cur:
+            version, = await cur.fetchone()
+    for version, statements in pending(version):
+        async with db.transaction() as conn:
+            # sqlite3 does not open a transaction for ddl by itself
+            await conn.execute("BEGIN")
+            for sql in statements:
+                if callable(sql):
+                    await sql(conn)
+                else:
+                    await conn.execute(sql)
+            await conn.execute("PRAGMA user_version = %d" % version)
@@ -0,0 +1,130 @@
+import asyncio
+import time
+from traceback import format_exc
+
+# telegram's cap on a message, the html is a bound on its text
+max_notice_length = 4096
+
+class Burst:
+    __slots__ = ("lines", "last", "msg_id", "shown", "task")
+
+    def __init__(self):
+        # (sender, duplicate links) in arrival order
+        self.lines: list[tuple[str, list[str]]] = []
+        self.last = 0.
+        self.msg_id: int | None = None
+        self.shown = 0
+        self.task: asyncio.Task | None = None
+
+class Notices:
+    # coalesces the duplicate notices of a chat topic: the first duplicate
+    # of a burst sends a notice, those following within window edit it to
+    # list theirs too. every send or edit pushes back its deletion, so the
+    # notice self-destructs once, delay seconds after the burst
+    def __init__(self, window=5, delay=10):
+        assert window < delay, "a burst can't outlive its notice"
+        self.window = window
+        self.delay = delay
+        self.sent = 0
+        self.edited = 0
+        self.coalesced = 0
+        self.failed = 0
+        self._bursts: dict[tuple[int, int | None], Burst] = {}
+        self._send = self._edit = self._expire = None
+
+    def start(self, send, edit, expire):
+        # send(chat_id, topic_id, text) returns the message,
+        # edit(chat_id, msg_id, text), expire(chat_id, msg_id, delay)
+        self._send = send
+        self._edit = edit
+        self._expire = expire
+
+    def add(self, chat_id, topic_id, sender, links):
+        key = chat_id, topic_id
+        now = time.monotonic()
+        burst = self._bursts.get(key)
+        if burst is None or now - burst.last > self.window:
+            burst = self._bursts[key] = Burst()
+        else:
+            self.coalesced += 1
+        burst.lines.append((sender, links))
+        burst.last = now
+        if burst.msg_id is not None:
+            self._expire(chat_id, burst.msg_id, self.delay)  # type: ignore
+        # while a send or edit is under way the lines pile up for the
+        # next one
+        if burst.task is None:
+            burst.task = asyncio.create_task(self._flush(key, burst))
+
+    def render(self, burst: Burst):
+        # the latest senders that fit, a sender's first links if even
+        # theirs alone doesn't
+        head = "Duplicate posts:"
+        tail = ("This message will self-destruct %ss after the last "
+                "duplicate" % self.delay)
+        earlier_template = "<i>%d earlier</i>"
+        budget = max_notice_length - len("\n\n".join((
+            head, earlier_template % len(burst.lines), tail)))
+        entries = []
+        for sender, links in reversed(burst.lines):
+            entry = "%s:\n%s" % (sender, "\n".join(links))
+            if len(entry) + 2 > budget:
+                if not entries:
+                    entry = sender + ":"
+                    for link in links:
+                        if len(entry) + len(link) + 3 > budget:
+                            break
+                        entry += "\n" + link
+                    entries.append(entry)
+                break
+            budget -= len(entry) + 2
+            entries.append(entry)
+        earlier = len(burst.lines) - len(entries)
+        return "\n\n".join((
+            head,
+            *([earlier_template % earlier] if earlier else []),
+            *reversed(entries),
+            tail))
+
+    async def _flush(self, key, burst: Burst):
+        chat_id, topic_id = key
+        try:
+            while burst.shown < len(burst.lines):
+                shown = len(burst.lines)
+                text = self.render(burst)
+                try:
+                    if burst.msg_id is None:
+                        msg = await self._send(  # type: ignore
+                            chat_id, topic_id, text)
+                        burst.msg_id = msg.id
+                        self.sent += 1
+                    else:
+                        await self._edit(  # type: ignore
+                            chat_id, burst.msg_id, text)
+                        self.edited += 1
+                except Exception:
+                    # the lines are shown by the next send or edit
+                    self.failed += 1
+                    print("Could not send duplicate notice:\n%s"
+                          % format_exc())
+                    return
+                self._expire(chat_id, burst.msg_id, self.delay)  # type: ignore
+                burst.shown = shown
+        finally:
+            burst.task = None
+            if self._bursts.get(key) is burst and burst.shown == len(
+                    burst.lines):
+                self._drop_later(key, burst)
+
+    def _drop_later(self, key, burst):
+        # forgotten with its notice, unless a duplicate came meanwhile
+        def drop():
+            if (self._bursts.get(key) is burst and burst.task is None
+                    and time.monotonic() - burst.last > self.window):
+                del self._bursts[key]
+        asyncio.get_running_loop().call_later(self.window, drop)
+
+    def format(self):
+        return ("Notices: %d sent, %d edits, %d coalesced, %d failed, "
+                "%d bursts" % (self.sent, self.edited, self.coalesced,
+                               self.failed, len(self._bursts)))
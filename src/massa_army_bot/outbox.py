@@ -0,0 +1,176 @@
+import asyncio
+import time
+from collections import deque
+from collections import OrderedDict
+
+from telethon import errors
+
+REPOST, NOTICE, LOG = range(3)
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.blocked_until = 0.
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def delay(self, now):
+        self._refill(now)
+        wait = max(0., self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until,
+                                 time.monotonic() + seconds)
+
+    def idle(self, now):
+        # as good as a new one
+        self._refill(now)
+        return self.tokens >= self.burst and self.blocked_until <= now
+
+class Outbox:
+    # bot api limits: ~30 messages/s overall, 1/s in a private chat,
+    # 20/min in a group
+    def __init__(self, global_rate=30, private_rate=1, group_rate=20 / 60,
+                 private_burst=3, group_burst=5, max_running=16,
+                 evict_interval=60.):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.private = private_rate, private_burst
+        self.group = group_rate, group_burst
+        self.max_running = max_running
+        self._buckets: dict[int, TokenBucket] = {}
+        self.evict_interval = evict_interval
+        self._next_evict = 0.
+        # one fifo per chat, per priority class
+        self._queues: list[OrderedDict[int, deque]] = [
+            OrderedDict() for _ in (REPOST, NOTICE, LOG)]
+        self._running: set[asyncio.Task] = set()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            ...
+        self._task = None
+        stopped = RuntimeError("Outbox stopped")
+        for queues in self._queues:
+            for chat_queue in queues.values():
+                for _, fut, _, _, _ in chat_queue:
+                    if not fut.done():
+                        fut.set_exception(stopped)
+            queues.clear()
+        # _execute fails their futures as it is cancelled
+        for task in self._running:
+            task.cancel()
+        await asyncio.gather(*self._running, return_exceptions=True)
+
+    def _evict(self, now):
+        # buckets of the chats gone quiet, a new one starts out full
+        queued = {chat_id for queues in self._queues for chat_id in queues}
+        for chat_id in [chat_id for chat_id, bucket in self._buckets.items()
+                        if chat_id not in queued and bucket.idle(now)]:
+            del self._buckets[chat_id]
+
+    def bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            rate, burst = self.private if chat_id > 0 else self.group
+            bucket = self._buckets[chat_id] = TokenBucket(rate, burst)
+        return bucket
+
+    def _push(self, priority, chat_id, item, front=False):
+        chat_queue = self._queues[priority].get(chat_id)
+        if chat_queue is None:
+            chat_queue = self._queues[priority][chat_id] = deque()
+        if front:
+            chat_queue.appendleft(item)
+        else:
+            chat_queue.append(item)
+        self._wakeup.set()
+
+    async def send(self, chat_id, func, *args, priority=NOTICE, **kwargs):
+        fut = asyncio.get_running_loop().create_future()
+        self._push(priority, chat_id, (chat_id, fut, func, args, kwargs))
+        return await fut
+
+    def _pick(self, now):
+        # highest priority first, round robin over the chats of a class
+        wait = None
+        global_wait = self.global_bucket.delay(now)
+        for priority, queues in enumerate(self._queues):
+            for chat_id, chat_queue in queues.items():
+                chat_wait = max(global_wait, self.bucket(chat_id).delay(now))
+                if chat_wait > 0:
+                    wait = chat_wait if wait is None else min(wait, chat_wait)
+                    continue
+                item = chat_queue.popleft()
+                if chat_queue:
+                    queues.move_to_end(chat_id)
+                else:
+                    del queues[chat_id]
+                return priority, item, None
+        return None, None, wait
+
+    async def _execute(self, priority, item):
+        chat_id, fut, func, args, kwargs = item
+        if fut.done():
+            return
+        try:
+            result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            if not fut.done():
+                fut.set_exception(RuntimeError("Outbox stopped"))
+            raise
+        except errors.FloodWaitError as e:
+            self.bucket(chat_id).block(e.seconds)
+            self._push(priority, chat_id, item, front=True)
+        except Exception as e:
+            if not fut.done():
+                fut.set_exception(e)
+        else:
+            if not fut.done():
+                fut.set_result(result)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if len(self._running) >= self.max_running:
+                await asyncio.wait(self._running,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                continue
+            now = time.monotonic()
+            if now >= self._next_evict:
+                self._evict(now)
+                self._next_evict = now + self.evict_interval
+            priority, item, wait = self._pick(now)
+            if item is not None:
+                self.global_bucket.take()
+                self.bucket(item[0]).take()
+                task = asyncio.create_task(self._execute(priority, item))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except TimeoutError:
+                ...
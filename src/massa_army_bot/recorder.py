@@ -0,0 +1,87 @@
+import struct
+import time
+from datetime import datetime
+from pathlib import Path
+from traceback import format_exc
+
+from telethon.extensions import BinaryReader
+
+# a log is a sequence of records, each a header with the record's kind,
+# unix time and payload length, then the payload: a serialized TLObject.
+# users and chats are written before the first update of the file that
+# refers to them, so each file replays on its own
+header = struct.Struct("<BdI")
+ENTITY = 0
+UPDATE = 1
+
+class Recorder:
+    # appends the updates the client dispatches to log files in
+    # directory, a new one past max_bytes, keeping the last few
+    def __init__(self, directory: Path, max_bytes=64 * 2**20, keep=20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.recorded = 0
+        self.errors = 0
+        self.path: Path | None = None
+        self._file = None
+        self._size = 0
+        self._entities: set[int] = set()
+
+    def _open(self):
+        self.directory.mkdir(exist_ok=True, parents=True)
+        self.path = self.directory / ("updates-%s.log" % datetime.now(
+        ).strftime("%Y%m%dT%H%M%S.%f"))
+        self._file = open(self.path, "ab", buffering=2**16)
+        self._size = 0
+        self._entities = set()
+        logs = sorted(self.directory.glob("updates-*.log"))
+        for path in logs[:-self.keep]:
+            path.unlink(missing_ok=True)
+
+    def _write(self, kind, at, obj):
+        payload = bytes(obj)
+        self._file.write(header.pack(kind, at, len(payload)))  # type: ignore
+        self._file.write(payload)  # type: ignore
+        self._size += header.size + len(payload)
+
+    def record(self, update):
+        try:
+            if self._file is None:
+                self._open()
+            at = time.time()
+            for peer_id, entity in getattr(update, "_entities", {}).items():
+                if peer_id not in self._entities:
+                    self._write(ENTITY, at, entity)
+                    self._entities.add(peer_id)
+            self._write(UPDATE, at, update)
+            self.recorded += 1
+            if self._size >= self.max_bytes:
+                self.close()
+        except Exception:
+            # losing a record beats losing the update
+            self.errors += 1
+            print(format_exc())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def format(self):
+        return "Recorder: %d updates, %d errors, %.1f MiB in %s" % (
+            self.recorded, self.errors, self._size / 2**20,
+            self.path.name if self.path else "-")
+
+def read_log(path: Path):
+    # yields (kind, at, obj), stops at a record cut short by a crash
+    with open(path, "rb") as f:
+        while True:
+            head = f.read(header.size)
+            if len(head) < header.size:
+                return
+            kind, at, length = header.unpack(head)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            yield kind, at, BinaryReader(payload).tgread_object()
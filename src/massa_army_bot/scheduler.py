@@ -0,0 +1,138 @@
+import asyncio
+import time
+from collections import defaultdict
+
+from .db import Database
+
+# telegram refuses more ids per delete_messages call
+max_delete_ids = 100
+
+class DeletionScheduler:
+    def __init__(self, db: Database, tick=1., slots=64, retry_delay=60.,
+                 max_attempts=5):
+        self.db = db
+        self.tick = tick
+        self.slots = slots
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.failed = 0
+        # hashed timer wheel: each slot holds (deadline_tick, chat_id, msg_id)
+        self._wheel: list[list[tuple[int, int, int]]] = [
+            [] for _ in range(slots)]
+        # the latest deadline of each message, scheduling it again
+        # leaves its earlier entries in the wheel to be skipped
+        self._deadlines: dict[tuple[int, int], int] = {}
+        self._current = int(time.time() // tick)
+        self._added: list[tuple[int, int, float]] = []
+        self._removed: list[tuple[int, int]] = []
+        # failed deletes of a message, it is tried again until it has
+        # had max_attempts
+        self._attempts: dict[tuple[int, int], int] = {}
+        self._delete = None
+        self._ready: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    async def start(self, delete, ready: asyncio.Event | None = None):
+        # delete(chat_id, msg_ids) raises when they weren't deleted.
+        # messages are loaded at once, and deleted once ready is set
+        self._delete = delete
+        self._ready = ready
+        self._current = int(time.time() // self.tick)
+        for chat_id, msg_id, deadline in await self.db.fetchall(
+                "SELECT chat_id, msg_id, deadline FROM pending_deletions"):
+            self._insert(chat_id, msg_id, deadline)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                ...
+            self._task = None
+        await self._persist()
+
+    def _insert(self, chat_id, msg_id, deadline):
+        deadline_tick = max(int(deadline // self.tick), self._current + 1)
+        self._deadlines[chat_id, msg_id] = deadline_tick
+        self._wheel[deadline_tick % self.slots].append(
+            (deadline_tick, chat_id, msg_id))
+
+    def schedule(self, chat_id, msg_ids, delay):
+        deadline = time.time() + delay
+        for msg_id in msg_ids:
+            self._insert(chat_id, msg_id, deadline)
+            self._added.append((chat_id, msg_id, deadline))
+
+    def _advance(self, now_tick):
+        due = defaultdict(list)
+        # after a long stall, one full turn of the wheel visits every slot
+        start = max(self._current + 1, now_tick - self.slots + 1)
+        for t in range(start, now_tick + 1):
+            idx = t % self.slots
+            slot = self._wheel[idx]
+            if not slot:
+                continue
+            keep = []
+            for entry in slot:
+                deadline_tick, chat_id, msg_id = entry
+                if self._deadlines.get((chat_id, msg_id)) != deadline_tick:
+                    continue
+                if deadline_tick <= now_tick:
+                    del self._deadlines[chat_id, msg_id]
+                    due[chat_id].append(msg_id)
+                else:
+                    keep.append(entry)
+            self._wheel[idx] = keep
+        self._current = max(self._current, now_tick)
+        return due
+
+    async def _fire(self, due):
+        assert self._delete is not None
+        batches = [(chat_id, msg_ids[i:i + max_delete_ids])
+                   for chat_id, msg_ids in due.items()
+                   for i in range(0, len(msg_ids), max_delete_ids)]
+        results = await asyncio.gather(*(
+            self._delete(chat_id, msg_ids) for chat_id, msg_ids in batches),
+            return_exceptions=True)
+        retry_at = time.time() + self.retry_delay
+        for (chat_id, msg_ids), result in zip(batches, results):
+            failed = isinstance(result, Exception)
+            for msg_id in msg_ids:
+                key = chat_id, msg_id
+                attempts = self._attempts.pop(key, 0) + failed
+                if failed and attempts < self.max_attempts:
+                    self._attempts[key] = attempts
+                    self._insert(chat_id, msg_id, retry_at)
+                    self._added.append((chat_id, msg_id, retry_at))
+                    continue
+                self.failed += failed
+                self._removed.append(key)
+
+    async def _persist(self):
+        added, self._added = self._added, []
+        removed, self._removed = self._removed, []
+        if not added and not removed:
+            return
+        async with self.db.transaction() as conn:
+            await conn.executemany(
+                "INSERT INTO pending_deletions (chat_id, msg_id, deadline) "
+                "VALUES (?, ?, ?) "
+                "ON CONFLICT (chat_id, msg_id) "
+                "DO UPDATE SET deadline = excluded.deadline",
+                added)
+            await conn.executemany(
+                "DELETE FROM pending_deletions "
+                "WHERE chat_id = ? AND msg_id = ?",
+                removed)
+
+    async def _run(self):
+        if self._ready is not None:
+            await self._ready.wait()
+        while True:
+            due = self._advance(int(time.time() // self.tick))
+            if due:
+                await self._fire(due)
+            await self._persist()
+            await asyncio.sleep(self.tick - time.time() % self.tick)
@@ -0,0 +1,165 @@
+import asyncio
+import threading
+import time
+from pathlib import Path
+
+from telethon import utils
+from telethon.sessions import MemorySession
+from telethon.sessions import SQLiteSession
+from telethon.tl import types
+
+class WriteBehindSession(MemorySession):
+    # telethon's sqlite session file, served from memory: the entities
+    # and update states telethon records on every rpc result and update
+    # are written back by save(), which telethon calls every minute, in
+    # a thread, and by close() at disconnect. the login itself, dc and
+    # auth key, is still written through at once
+    def __init__(self, path: Path):
+        super().__init__()
+        self.disk = SQLiteSession(str(path))
+        self._dc_id = self.disk.dc_id
+        self._server_address = self.disk.server_address
+        self._port = self.disk.port
+        self._auth_key = self.disk.auth_key
+        self._takeout_id = self.disk.takeout_id
+        self._rows: dict[int, tuple] = {}
+        self._by_username: dict[str, int] = {}
+        self._dirty_rows: set[int] = set()
+        self._dirty_states: set[int] = set()
+        self._flush_lock = threading.Lock()
+        self._flushing: asyncio.Future | None = None
+        self.flushes = 0
+        self.flushed_rows = 0
+        c = self.disk._cursor()
+        try:
+            for row in c.execute(
+                    "SELECT id, hash, username, phone, name FROM entities"):
+                self._set_row(row)
+        finally:
+            c.close()
+        self._update_states = dict(self.disk.get_update_states())
+
+    def set_dc(self, dc_id, server_address, port):
+        super().set_dc(dc_id, server_address, port)
+        with self._flush_lock:
+            self.disk.set_dc(dc_id, server_address, port)
+
+    @MemorySession.auth_key.setter
+    def auth_key(self, value):
+        self._auth_key = value
+        with self._flush_lock:
+            self.disk.auth_key = value
+            self.disk.save()
+
+    @MemorySession.takeout_id.setter
+    def takeout_id(self, value):
+        self._takeout_id = value
+        with self._flush_lock:
+            self.disk.takeout_id = value
+            self.disk.save()
+
+    def set_update_state(self, entity_id, state):
+        self._update_states[entity_id] = state
+        self._dirty_states.add(entity_id)
+
+    def _set_row(self, row):
+        id, _, username, _, _ = row
+        old = self._rows.get(id)
+        if old is not None and old[2] is not None:
+            self._by_username.pop(old[2], None)
+        self._rows[id] = row
+        if username is not None:
+            self._by_username[username] = id
+
+    def process_entities(self, tlo):
+        for row in self._entities_to_rows(tlo):
+            if self._rows.get(row[0]) != row:
+                self._set_row(row)
+                self._dirty_rows.add(row[0])
+
+    def get_entity_rows_by_id(self, id, exact=True):
+        ids = (id,) if exact else (
+            utils.get_peer_id(types.PeerUser(id)),
+            utils.get_peer_id(types.PeerChat(id)),
+            utils.get_peer_id(types.PeerChannel(id)))
+        for found_id in ids:
+            row = self._rows.get(found_id)
+            if row is not None:
+                return found_id, row[1]
+
+    def get_entity_rows_by_username(self, username):
+        id = self._by_username.get(username)
+        if id is not None:
+            return id, self._rows[id][1]
+
+    def get_entity_rows_by_phone(self, phone):
+        return next(((id, hash) for id, hash, _, found_phone, _
+                     in self._rows.values() if found_phone == phone), None)
+
+    def get_entity_rows_by_name(self, name):
+        return next(((id, hash) for id, hash, _, _, found_name
+                     in self._rows.values() if found_name == name), None)
+
+    def _take_dirty(self):
+        rows = [self._rows[id] for id in self._dirty_rows]
+        states = [(id, self._update_states[id]) for id in self._dirty_states]
+        self._dirty_rows = set()
+        self._dirty_states = set()
+        return rows, states
+
+    def _write(self, rows, states):
+        with self._flush_lock:
+            c = self.disk._cursor()
+            try:
+                now = int(time.time())
+                c.executemany(
+                    "INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?)",
+                    [row + (now,) for row in rows])
+                c.executemany(
+                    "INSERT OR REPLACE INTO update_state "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [(id, state.pts, state.qts, state.date.timestamp(),
+                      state.seq) for id, state in states])
+                self.disk.save()
+            finally:
+                c.close()
+        self.flushes += 1
+        self.flushed_rows += len(rows) + len(states)
+
+    def _written(self, rows, states, fut):
+        self._flushing = None
+        if fut.cancelled() or fut.exception() is None:
+            return
+        print("Session flush failed: %r" % fut.exception())
+        # written again, with their latest values, by the next flush
+        for row in rows:
+            self._dirty_rows.add(row[0])
+        for id, _ in states:
+            self._dirty_states.add(id)
+
+    def save(self):
+        if self._flushing is not None or not (self._dirty_rows
+                                              or self._dirty_states):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(*self._take_dirty())
+            return
+        rows, states = self._take_dirty()
+        self._flushing = loop.run_in_executor(None, self._write, rows, states)
+        self._flushing.add_done_callback(
+            lambda fut: self._written(rows, states, fut))
+
+    def close(self):
+        # at disconnect, after telethon recorded the final states
+        self._write(*self._take_dirty())
+        self.disk.close()
+
+    def delete(self):
+        return self.disk.delete()
+
+    def format(self):
+        return "Session: %d entities, %d pending, %d flushes, %d rows" % (
+            len(self._rows), len(self._dirty_rows) + len(self._dirty_states),
+            self.flushes, self.flushed_rows)
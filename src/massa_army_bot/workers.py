@@ -0,0 +1,252 @@
+import asyncio
+import multiprocessing
+import threading
+from functools import partial
+from itertools import count
+from pathlib import Path
+from traceback import format_exc
+
+from .db import Database
+from .db import TwPostsIndex
+from .db import TwPostsWriter
+from .dedup import plan_dedup
+from .metrics import waiting
+
+# inputs are (item_id, item), or (None, (tg_msg_chat, post_ids)) for
+# the posts pruned from its shard. results are (item_id, actions, error),
+# a worker announces it is warm with an item_id of None, or fails to
+# start with one and an error
+
+def _drain(queue, loop, handle):
+    # blocking gets in a thread of their own, handled in the loop
+    while True:
+        msg = queue.get()
+        loop.call_soon_threadsafe(handle, msg)
+        if msg is None:
+            return
+
+def _drain_results(conn, loop, handle):
+    # a pipe per worker, so that one dying mid-write can't hold up the
+    # others. None once it exited, or died
+    while True:
+        try:
+            msg = conn.recv()
+        except Exception:
+            conn.close()
+            loop.call_soon_threadsafe(handle, None)
+            return
+        loop.call_soon_threadsafe(handle, msg)
+
+class Workers:
+    # runs plan_dedup in processes of their own, sharded by chat id so
+    # that a chat's posts are only ever indexed and written by one of
+    # them, and a slow chat only holds up its shard. a worker that dies
+    # fails the items it was given and is started again
+    def __init__(self, path: Path, count=0, busy_timeout=30.):
+        self.path = path
+        self.count = count
+        self.busy_timeout = busy_timeout
+        self.submitted = 0
+        self.failed = 0
+        self.restarts = 0
+        self._ids = iter(())
+        # item_id: (shard, future)
+        self._pending: dict[int, tuple[int, asyncio.Future]] = {}
+        self._ctx = None
+        self._inputs = []
+        self._processes = []
+        self._readers: list[threading.Thread] = []
+        self._ready: asyncio.Future | None = None
+        self._starting = 0
+        self._stopping = False
+
+    def shard(self, chat_id):
+        return abs(chat_id) % self.count
+
+    def _spawn(self, shard):
+        inputs = self._ctx.Queue()  # type: ignore
+        results, sender = self._ctx.Pipe(duplex=False)  # type: ignore
+        process = self._ctx.Process(  # type: ignore
+            target=worker_main, name="dedup-%d" % shard, daemon=True,
+            args=(str(self.path), shard, self.count, self.busy_timeout,
+                  inputs, sender))
+        process.start()
+        # the worker holds the only write end, its exit ends the pipe
+        sender.close()
+        reader = threading.Thread(
+            target=_drain_results, daemon=True,
+            args=(results, asyncio.get_running_loop(),
+                  partial(self._resolve, shard, process)))
+        reader.start()
+        self._readers.append(reader)
+        return inputs, process
+
+    async def start(self):
+        if not self.count or self._processes:
+            return
+        # the client and its threads aren't fork safe
+        self._ctx = multiprocessing.get_context("spawn")
+        self._ids = count()
+        self._ready = asyncio.get_running_loop().create_future()
+        self._starting = self.count
+        self._stopping = False
+        for shard in range(self.count):
+            inputs, process = self._spawn(shard)
+            self._inputs.append(inputs)
+            self._processes.append(process)
+        try:
+            await self._ready
+        except BaseException:
+            await self.stop()
+            raise
+
+    def _restart(self, shard, process):
+        error = RuntimeError("Dedup worker %d exited with %s" % (
+            shard, process.exitcode))
+        for item_id, (item_shard, fut) in list(self._pending.items()):
+            if item_shard == shard:
+                del self._pending[item_id]
+                if not fut.done():
+                    self.failed += 1
+                    fut.set_exception(error)
+        assert self._ready is not None
+        if not self._ready.done():
+            self._ready.set_exception(error)
+            return
+        if self._ready.exception() is not None:
+            # start() failed, and stops the others
+            return
+        # what the dead worker didn't read is failed above
+        self._inputs[shard].cancel_join_thread()
+        self._inputs[shard].close()
+        self._inputs[shard], self._processes[shard] = self._spawn(shard)
+        self.restarts += 1
+        print("%s, restarted" % error)
+
+    def _resolve(self, shard, process, msg):
+        if msg is None:
+            process.join()
+            if not self._stopping and self._processes[shard] is process:
+                self._restart(shard, process)
+            return
+        item_id, actions, error = msg
+        if item_id is None:
+            if self._ready is None or self._ready.done():
+                if error is not None:
+                    print("Dedup worker %d failed to start:\n%s" % (
+                        shard, error))
+                return
+            if error is not None:
+                self._ready.set_exception(RuntimeError(
+                    "Dedup worker failed to start:\n%s" % error))
+                return
+            self._starting -= 1
+            if not self._starting:
+                self._ready.set_result(None)
+            return
+        _, fut = self._pending.pop(item_id, (None, None))
+        if fut is None or fut.done():
+            return
+        if error is not None:
+            self.failed += 1
+            fut.set_exception(RuntimeError(
+                "Dedup worker failed:\n%s" % error))
+        else:
+            fut.set_result(actions)
+
+    async def submit(self, item):
+        item_id = next(self._ids)
+        fut = asyncio.get_running_loop().create_future()
+        shard = self.shard(item.chat_id)
+        self._pending[item_id] = shard, fut
+        self._inputs[shard].put((item_id, item))
+        self.submitted += 1
+        try:
+            with waiting("worker"):
+                return await fut
+        finally:
+            self._pending.pop(item_id, None)
+
+    def forget(self, tg_msg_chat, post_ids):
+        # pruned posts, before the worker takes its next items
+        if not self._processes:
+            return
+        self._inputs[self.shard(tg_msg_chat)].put(
+            (None, (tg_msg_chat, post_ids)))
+
+    async def stop(self):
+        if not self._processes:
+            return
+        self._stopping = True
+        loop = asyncio.get_running_loop()
+        # workers finish what they were given before exiting
+        for inputs in self._inputs:
+            inputs.put(None)
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join)
+        for reader in self._readers:
+            await loop.run_in_executor(None, reader.join)
+        # the readers' last calls
+        await asyncio.sleep(0)
+        for _, fut in self._pending.values():
+            fut.cancel()
+        self._pending.clear()
+        self._inputs.clear()
+        self._processes.clear()
+        self._readers.clear()
+        self._ready = None
+
+    def format(self):
+        return ("Workers: %d processes, %d submitted, %d pending, "
+                "%d failed, %d restarts" % (
+                    len(self._processes), self.submitted,
+                    len(self._pending), self.failed, self.restarts))
+
+def worker_main(path, shard, shards, busy_timeout, inputs, results):
+    asyncio.run(serve(Path(path), shard, shards, busy_timeout,
+                      inputs, results))
+
+async def serve(path, shard, shards, busy_timeout, inputs, results):
+    # the processes write to the same file, each waits out the others
+    db = Database(path, busy_timeout=busy_timeout)
+    tw_posts = TwPostsIndex(db, TwPostsWriter(db))
+    try:
+        await db.open()
+        tw_posts.start()
+        await tw_posts.warm(shard=(shard, shards))
+    except Exception:
+        results.send((None, None, format_exc()))
+        await db.close()
+        return
+    results.send((None, None, None))
+
+    # items come with their titles, there is no client to render them
+    async def handle(item_id, item):
+        try:
+            actions = await plan_dedup(item, tw_posts, None)
+        except Exception:
+            results.send((item_id, None, format_exc()))
+        else:
+            results.send((item_id, actions, None))
+
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    tasks = set()
+    def received(msg):
+        if msg is None:
+            stopped.set()
+            return
+        item_id, item = msg
+        if item_id is None:
+            tw_posts.forget(*item)
+            return
+        task = asyncio.create_task(handle(item_id, item))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    reader = threading.Thread(target=_drain, args=(inputs, loop, received),
+                              daemon=True)
+    reader.start()
+    await stopped.wait()
+    await asyncio.gather(*tasks)
+    await tw_posts.stop()
+    await db.close()
@@ -0,0 +1,129 @@
+import asyncio
+import importlib
+import inspect
+import io
+from contextlib import redirect_stdout
+
+import pytest
+from telethon import TelegramClient
+from telethon import types
+
+from bench.fake import FakeClient
+from massa_army_bot import bot
+from massa_army_bot.bot import HalfRed
+from massa_army_bot.outbox import Outbox
+
+def test_pinned_telethon_has_call():
+    # what configure() times every rpc with
+    assert inspect.iscoroutinefunction(TelegramClient._call)
+
+def test_configure_refuses_a_client_without_call():
+    class Client:
+        ...
+    with pytest.raises(RuntimeError, match="_call"):
+        HalfRed().configure("bench_bot", 0, "x", "x", -100, client=Client())
+
+def test_render_name_counts_a_lookup_once():
+    async def run():
+        hr = HalfRed()
+        async def get_entity():
+            return types.User(id=10, first_name="Raider")
+        for _ in range(2):
+            await hr.render_name(10, get_entity)
+        assert (hr.names.hits, hr.names.misses) == (1, 1)
+    asyncio.run(run())
+
+env = {"TG_API_ID": "0", "TG_API_HASH": "x", "TG_BOT_TOKEN": "x",
+       "TG_BOT_USERNAME": "bench_bot", "TG_LOG_CHANNEL": "-1000000000000"}
+status_url = "https://x.com/raider/status/%d"
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # a fresh bot, its database under tmp_path
+    monkeypatch.chdir(tmp_path)
+    module = importlib.reload(bot)
+    client = FakeClient()
+    module.create_app(env=env, client=client)
+    unlimited = 10**9
+    module.hr.outbox = Outbox(
+        global_rate=unlimited, private_rate=unlimited,
+        group_rate=unlimited, private_burst=unlimited,
+        group_burst=unlimited, max_running=unlimited)
+    return module, client
+
+def run(app, scenario):
+    module, client = app
+    async def main():
+        with redirect_stdout(io.StringIO()):
+            await module.hr.start(init=module.init_bot)
+        try:
+            await scenario(module, client)
+        finally:
+            with redirect_stdout(io.StringIO()):
+                await module.hr.stop(fini=module.fini_db)
+    asyncio.run(main())
+
+async def raid_chat(module, client, channel_id):
+    chat_id = client.add_channel(channel_id, "Raid %d" % channel_id)
+    raid_topic = client.add_topic(chat_id, "Raids")
+    await module.db.execute("INSERT INTO raid_topics VALUES (?, ?)",
+                            (chat_id, raid_topic))
+    return chat_id, raid_topic
+
+async def post(client, chat_id, sender_id, post_id, topic=None,
+               prefix="raid "):
+    url = status_url % post_id
+    msg = client.make_message(
+        chat_id, sender_id, prefix + url, reply_to=topic,
+        entities=[types.MessageEntityUrl(len(prefix), len(url))])
+    with redirect_stdout(io.StringIO()):
+        await client.dispatch(msg)
+        await asyncio.sleep(.05)
+    return msg
+
+def sent(client, chat_id):
+    return [msg for (c, _), msg in sorted(client.messages.items())
+            if c == chat_id and msg.out]
+
+def test_new_posts_are_reposted_once(app):
+    async def scenario(module, client):
+        chat_id, raid_topic = await raid_chat(module, client, 1000)
+        general = client.add_topic(chat_id, "General")
+        client.add_user(10, "Raider")
+        await post(client, chat_id, 10, 1, topic=general)
+        reposts = sent(client, chat_id)
+        assert len(reposts) == 1
+        assert status_url % 1 in reposts[0].message
+        assert reposts[0].reply_to.reply_to_msg_id == raid_topic
+        # already raided, not reposted again
+        await post(client, chat_id, 10, 1, topic=general)
+        assert len(sent(client, chat_id)) == 1
+    run(app, scenario)
+
+def test_duplicates_in_the_raid_topic_get_a_notice(app):
+    async def scenario(module, client):
+        chat_id, raid_topic = await raid_chat(module, client, 1001)
+        client.add_user(10, "Raider")
+        client.add_user(11, "Latecomer")
+        await post(client, chat_id, 10, 2, topic=raid_topic, prefix="")
+        assert sent(client, chat_id) == []
+        await post(client, chat_id, 11, 2, topic=raid_topic, prefix="")
+        notice, = sent(client, chat_id)
+        assert notice.message.startswith("Duplicate posts:")
+        assert "Latecomer" in notice.message
+    run(app, scenario)
+
+def test_linked_chats_without_a_raid_topic_dedup_at_the_source(app):
+    async def scenario(module, client):
+        chat_id, raid_topic = await raid_chat(module, client, 1002)
+        fed = client.add_channel(1003, "Fed")
+        await module.db.execute("INSERT INTO linked_chats VALUES (?, ?)",
+                                (1002, fed))
+        general = client.add_topic(chat_id, "General")
+        client.add_user(10, "Raider")
+        await post(client, chat_id, 10, 3, topic=general)
+        assert sent(client, fed) == []
+        repost, = sent(client, chat_id)
+        assert status_url % 3 in repost.message
+        assert repost.reply_to.reply_to_msg_id == raid_topic
+    run(app, scenario)
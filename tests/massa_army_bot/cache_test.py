@@ -0,0 +1,54 @@
+import asyncio
+import time
+
+from telethon import types
+
+from massa_army_bot.cache import TTLCache
+
+def test_a_write_wins_over_a_running_fetch():
+    async def run():
+        cache = TTLCache()
+        started = asyncio.Event()
+        async def load():
+            # reads the row from before the write
+            started.set()
+            await asyncio.sleep(.05)
+            return None
+        fetch = asyncio.create_task(cache.get_or_fetch(-1, load))
+        await started.wait()
+        cache[-1] = 5
+        assert await fetch is None
+        assert cache[-1] == 5
+    asyncio.run(run())
+
+def test_cached_misses_expire():
+    async def run():
+        cache = TTLCache(ttl=.05)
+        rows = {}
+        async def load():
+            return rows.get(-1)
+        assert await cache.get_or_fetch(-1, load) is None
+        rows[-1] = 5
+        assert await cache.get_or_fetch(-1, load) is None
+        time.sleep(.06)
+        assert await cache.get_or_fetch(-1, load) == 5
+        assert cache.expirations == 1
+    asyncio.run(run())
+
+def test_groups_drop_their_entries_only():
+    cache = TTLCache(maxsize=3, group=lambda key: key[0])
+    cache[1, "a"] = cache[1, "b"] = cache[2, "a"] = "name"
+    cache.invalidate_group(1)
+    assert len(cache) == 1 and (2, "a") in cache
+    # evicted and popped entries leave their group
+    cache[3, "a"] = cache[4, "a"] = cache[5, "a"] = "name"
+    cache.pop((5, "a"))
+    assert cache._groups == {3: {(3, "a")}, 4: {(4, "a")}}
+
+def test_group_invalidation_on_updates():
+    cache = TTLCache(group=lambda key: key[0])
+    cache.invalidate_on(types.UpdateUserName,
+                        group=lambda update: update.user_id)
+    cache[10, "a"] = cache[11, "a"] = "name"
+    cache.on_update(types.UpdateUserName(10, "New", "", []))
+    assert list(cache._data) == [(11, "a")]
@@ -0,0 +1,36 @@
+import asyncio
+
+import pytest
+
+from massa_army_bot.dispatch import Dispatcher
+
+def test_a_cancelled_waiter_gives_its_slot_back():
+    async def run():
+        dispatcher = Dispatcher(max_running=1, per_chat=1)
+        await dispatcher.acquire(-1)
+        waiter = asyncio.create_task(dispatcher.acquire(-1))
+        await asyncio.sleep(0)
+        # the release comes before the waiter steps out of acquire
+        waiter.cancel()
+        dispatcher.release(-1)
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert dispatcher.running == 0
+        assert not dispatcher._busy and not dispatcher._waiting
+        assert dispatcher.depth == 0
+        await asyncio.wait_for(dispatcher.acquire(-1), 1)
+    asyncio.run(run())
+
+def test_a_waiter_granted_as_it_is_cancelled_releases():
+    async def run():
+        dispatcher = Dispatcher(max_running=1, per_chat=1)
+        await dispatcher.acquire(-1)
+        waiter = asyncio.create_task(dispatcher.acquire(-1))
+        await asyncio.sleep(0)
+        dispatcher.release(-1)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert dispatcher.running == 0
+        assert dispatcher.depth == 0
+    asyncio.run(run())
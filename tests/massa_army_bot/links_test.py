@@ -0,0 +1,61 @@
+from telethon import types
+
+from massa_army_bot.links import extract_links
+from massa_army_bot.links import has_more_text
+
+def utf16_len(text):
+    return len(text.encode("utf-16-le")) // 2
+
+def message(*parts):
+    # the text of parts, urls as entities at their utf-16 offsets
+    text = ""
+    entities = []
+    for part, is_url in parts:
+        if is_url:
+            entities.append(types.MessageEntityUrl(utf16_len(text),
+                                                   utf16_len(part)))
+        text += part
+    return text, entities
+
+def test_urls_after_non_bmp_text():
+    url = "https://x.com/raider/status/123"
+    # 🚀 and 𝕏 are two utf-16 code units each
+    text, entities = message(("🚀𝕏 raid ", False), (url, True),
+                             (" 🔥 ", False), ("x.com/other/status/4", True))
+    assert utf16_len(text) > len(text)
+    first, second = extract_links(text, entities)
+    assert (first.tw_username, first.tw_post_id, first.url) == (
+        "raider", 123, url)
+    assert (second.tw_username, second.tw_post_id) == ("other", 4)
+    assert (first.start, first.end) == (entities[0].offset,
+                                        entities[0].offset + len(url))
+
+def test_text_urls_and_other_urls():
+    url = "https://twitter.com/raider/status/5"
+    text = "🚀 this and https://example.com"
+    entities = [types.MessageEntityTextUrl(2, 4, url),
+                types.MessageEntityUrl(12, 19)]
+    link, = extract_links(text, entities)
+    assert (link.tw_post_id, link.url) == (5, url)
+
+def test_links_only():
+    text, entities = message(
+        ("x.com/a/status/1", True), ("\n ", False),
+        ("x.com/b/status/2", True), ("  ", False))
+    assert not has_more_text(text, extract_links(text, entities))
+
+def test_links_and_text():
+    link = "x.com/a/status/1", True
+    for parts in (
+            (("🚀 ", False), link),
+            (link, (" 𝕏", False)),
+            (link, (" 🚀 ", False), link)):
+        text, entities = message(*parts)
+        assert has_more_text(text, extract_links(text, entities))
+
+def test_a_stripped_prefix_is_not_more_text():
+    text, entities = message(("/ignore_duplicate ", False),
+                             ("x.com/a/status/1", True))
+    links = extract_links(text, entities)
+    assert has_more_text(text, links)
+    assert not has_more_text(text, links, lstrip=("/ignore_duplicate",))
@@ -0,0 +1,63 @@
+import asyncio
+import io
+from contextlib import redirect_stdout
+
+from massa_army_bot.logsink import LogSink
+
+def sink(**kwargs):
+    sent = []
+    async def send(text, file=None, **kwargs):
+        sent.append((text, file, kwargs))
+    return LogSink(send, flush_delay=0, **kwargs), sent
+
+def test_entries_are_batched_up_to_the_message_length():
+    async def run():
+        logs, sent = sink(max_len=10, sep="|")
+        for text in ("aaa", "bbb", "ccc", "dddddddddddd"):
+            logs.put(text)
+        logs.put("eee", file="trace.txt")
+        logs.put("fff", parse_mode="html")
+        logs.put("ggg")
+        logs.start()
+        await logs.stop()
+        assert sent == [
+            ("aaa|bbb", None, {}),
+            ("ccc", None, {}),
+            # too long to share a message, sent as is
+            ("dddddddddddd", None, {}),
+            ("eee", "trace.txt", {}),
+            ("fff", None, {"parse_mode": "html"}),
+            ("ggg", None, {}),
+        ]
+    asyncio.run(run())
+
+def test_a_full_queue_keeps_entries_local():
+    async def run():
+        logs, sent = sink(maxsize=2)
+        assert logs.put("a") and logs.put("b")
+        assert not logs.put("c")
+        assert logs.dropped == 1
+        logs.start()
+        # stop waits for room in the queue
+        await logs.stop()
+        text, = [text for text, _, _ in sent]
+        assert text == "a\n\nb\n\n<i>1 log entries dropped</i>"
+        assert logs.dropped == 0
+    asyncio.run(run())
+
+def test_a_failed_send_does_not_stop_the_sink():
+    async def run():
+        sent = []
+        async def send(text, file=None, **kwargs):
+            if file is not None:
+                raise RuntimeError("upload failed")
+            sent.append(text)
+        logs = LogSink(send, flush_delay=0)
+        logs.put("a", file="trace.txt")
+        logs.put("b")
+        logs.start()
+        with redirect_stdout(io.StringIO()) as out:
+            await logs.stop()
+        assert "upload failed" in out.getvalue()
+        assert sent == ["b"]
+    asyncio.run(run())
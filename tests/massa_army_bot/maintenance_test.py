@@ -0,0 +1,123 @@
+import asyncio
+import time
+
+from massa_army_bot.db import backfill_tw_post_sql
+from massa_army_bot.db import Database
+from massa_army_bot.db import insert_tw_post_sql
+from massa_army_bot.db import insert_tw_user_sql
+from massa_army_bot.db import post_params
+from massa_army_bot.db import TwPostsIndex
+from massa_army_bot.db import TwPostsWriter
+from massa_army_bot.maintenance import Maintenance
+from massa_army_bot.migrations import migrate
+
+async def pragma(db, name):
+    # on the writer, which made the changes
+    async with db.transaction() as conn:
+        async with conn.execute("PRAGMA main.%s" % name) as cur:
+            row = await cur.fetchone()
+    return row[0]
+
+async def filled(tmp_path):
+    db = Database(tmp_path / "db.sqlite3")
+    await db.open()
+    await migrate(db)
+    await db.execute("CREATE TABLE filler (data BLOB)")
+    await db.executemany("INSERT INTO filler VALUES (randomblob(4000))",
+                         [()] * 500)
+    maintenance = Maintenance(db, TwPostsIndex(db, TwPostsWriter(db)),
+                              tmp_path / "archive.sqlite3")
+    return db, maintenance
+
+def test_rebuild_waits_for_a_quiet_run(tmp_path):
+    async def run():
+        db, maintenance = await filled(tmp_path)
+        try:
+            await maintenance.start()
+            # not rebuilt while starting
+            assert maintenance.rebuild
+            assert await pragma(db, "auto_vacuum") == 0
+            await maintenance.run()
+            assert not maintenance.rebuild
+            assert await pragma(db, "auto_vacuum") == 2
+        finally:
+            await maintenance.stop()
+            await db.close()
+    asyncio.run(run())
+
+def test_vacuum_credits_the_pages_freed(tmp_path):
+    async def run():
+        db, maintenance = await filled(tmp_path)
+        maintenance.vacuum_pages = 100
+        try:
+            await maintenance.start()
+            await maintenance.rebuild_db()
+            await db.execute("DELETE FROM filler")
+            free = await pragma(db, "freelist_count")
+            assert free > 100
+            await maintenance.vacuum()
+            assert await pragma(db, "freelist_count") == 0
+            assert maintenance.vacuumed_pages == free
+        finally:
+            await maintenance.stop()
+            await db.close()
+    asyncio.run(run())
+
+posts_sql = (
+    "SELECT tg_msg_chat, tg_msg_topic, tg_msg_at, tg_msg_by "
+    "FROM main.tw_posts UNION ALL "
+    "SELECT tg_msg_chat, tg_msg_topic, tg_msg_at, tg_msg_by "
+    "FROM archive.tw_posts")
+rollups = {
+    "SELECT tg_msg_chat, tg_msg_topic, day, posts FROM daily_posts "
+    "WHERE posts ORDER BY 1, 2, 3":
+    "SELECT tg_msg_chat, coalesce(tg_msg_topic, 0), tg_msg_at / 86400, "
+    "count(*) FROM (%s) GROUP BY 1, 2, 3 ORDER BY 1, 2, 3" % posts_sql,
+    "SELECT tg_msg_chat, tg_msg_topic, day, tg_msg_by, posts "
+    "FROM daily_sharers WHERE posts ORDER BY 1, 2, 3, 4":
+    "SELECT tg_msg_chat, coalesce(tg_msg_topic, 0), tg_msg_at / 86400, "
+    "tg_msg_by, count(*) FROM (%s) GROUP BY 1, 2, 3, 4 "
+    "ORDER BY 1, 2, 3, 4" % posts_sql,
+}
+
+async def assert_rollups_match(db):
+    # pruned posts stay counted: the posts are the kept and archived ones
+    async with db.transaction() as conn:
+        for rollup_sql, posts_sql in rollups.items():
+            async with conn.execute(rollup_sql) as cur:
+                rollup = await cur.fetchall()
+            async with conn.execute(posts_sql) as cur:
+                posts = await cur.fetchall()
+            assert rollup and rollup == posts
+
+def test_raid_stats_follow_inserts_backfills_and_prunes(tmp_path):
+    async def run():
+        db, maintenance = await filled(tmp_path)
+        day = 24 * 60 * 60
+        now = int(time.time())
+        chat = -1001234567890
+        # a post every half day by three sharers in three topics,
+        # the last 40 older than the 30 days kept
+        rows = [("a", post_id, 10 + post_id % 3,
+                 now - post_id * day // 2 - day // 4, chat,
+                 100 + post_id, (None, 7, 8)[post_id % 3], None)
+                for post_id in range(1, 100)]
+        rows.append(("b", 1, 20, now, -1009876543210, 5, None, None))
+        try:
+            await maintenance.start()
+            await db.executemany(insert_tw_user_sql, [("a",), ("b",)])
+            await db.executemany(insert_tw_post_sql, map(post_params, rows))
+            await assert_rollups_match(db)
+            # older messages found by a backfill take the posts over
+            await db.executemany(backfill_tw_post_sql, [
+                post_params(("a", post_id, 30, now - 90 * day, chat,
+                             10 + post_id, 9, None))
+                for post_id in (1, 2, 50)])
+            await assert_rollups_match(db)
+            await maintenance.prune()
+            assert maintenance.archived == 40 + 3
+            await assert_rollups_match(db)
+        finally:
+            await maintenance.stop()
+            await db.close()
+    asyncio.run(run())
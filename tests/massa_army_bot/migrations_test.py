@@ -0,0 +1,63 @@
+import asyncio
+import sqlite3
+
+from massa_army_bot.db import Database
+from massa_army_bot.db import message_url
+from massa_army_bot.migrations import migrate
+from massa_army_bot.migrations import migrations
+
+chat = -1001234567890
+legacy_insert_sql = "INSERT INTO tw_posts VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+
+def legacy_db(path, rows):
+    conn = sqlite3.connect(path)
+    for sql in migrations[0]:
+        conn.execute(sql)
+    conn.execute("PRAGMA user_version = 1")
+    conn.executemany(legacy_insert_sql, rows)
+    conn.commit()
+    conn.close()
+
+def migrated(path):
+    async def run():
+        db = Database(path)
+        await db.open()
+        try:
+            await migrate(db)
+            return await db.fetchall(
+                "SELECT tw_post_id, tg_msg_chat, tg_msg_id, tg_msg_topic "
+                "FROM tw_posts ORDER BY tw_post_id")
+        finally:
+            await db.close()
+    return asyncio.run(run())
+
+def test_legacy_links_survive(tmp_path):
+    path = tmp_path / "legacy.sqlite3"
+    legacy = [
+        # the baseline stored message and topic ids swapped
+        ("a", 1, 10, 1700000000, chat, 7, 555, message_url(chat, 555)),
+        # the ids in order
+        ("b", 2, 10, 1700000001, chat, 600, 7, message_url(chat, 600)),
+        # a topic's first message, its own topic
+        ("c", 3, 10, 1700000002, chat, 7, 7, message_url(chat, 7)),
+    ]
+    legacy_db(path, legacy)
+    rows = migrated(path)
+    assert rows == [(1, chat, 555, 7), (2, chat, 600, 7), (3, chat, 7, 7)]
+    for row, (_, tg_msg_chat, tg_msg_id, _) in zip(legacy, rows):
+        assert message_url(tg_msg_chat, tg_msg_id) == row[-1]
+
+def test_legacy_rows_without_url_kept(tmp_path):
+    path = tmp_path / "legacy.sqlite3"
+    legacy_db(path, [("a", 1, 10, 1700000000, chat, 600, 7, None)])
+    assert migrated(path) == [(1, chat, 600, 7)]
+
+def test_usernames_in_any_case_keep_their_posts(tmp_path):
+    path = tmp_path / "legacy.sqlite3"
+    legacy_db(path, [
+        (username, post_id, 10, 1700000000 + post_id, chat, 7,
+         600 + post_id, message_url(chat, 600 + post_id))
+        for username, post_id in (
+            ("elonmusk", 1), ("ElonMusk", 2), ("ELONMUSK", 3))])
+    assert migrated(path) == [(1, chat, 601, 7), (2, chat, 602, 7),
+                              (3, chat, 603, 7)]
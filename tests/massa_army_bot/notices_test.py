@@ -0,0 +1,58 @@
+import asyncio
+
+from massa_army_bot.notices import Burst
+from massa_army_bot.notices import max_notice_length
+from massa_army_bot.notices import Notices
+
+def link(n):
+    url = "https://x.com/raider_account_%d/status/%d" % (n, 10**18 + n)
+    return '<a href="%s">%s</a>' % (url, url)
+
+def burst(lines):
+    b = Burst()
+    b.lines = lines
+    return b
+
+def test_render_fits_telegram():
+    notices = Notices()
+    text = notices.render(burst([
+        ("<b>sender %d</b>" % n, [link(n * 5 + i) for i in range(5)])
+        for n in range(20)]))
+    assert len(text) <= max_notice_length
+    # the latest senders are the ones shown
+    assert "sender 19" in text
+    assert "earlier</i>" in text
+
+def test_render_cuts_one_long_message():
+    notices = Notices()
+    text = notices.render(burst([("<b>sender</b>",
+                                  [link(i) for i in range(200)])]))
+    assert len(text) <= max_notice_length
+    assert link(0) in text
+
+def test_burst_shares_one_notice():
+    async def run():
+        texts = {}
+        expired = []
+        async def send(chat_id, topic_id, text):
+            await asyncio.sleep(.01)
+            texts[1] = text
+            return type("Message", (), {"id": 1})
+        async def edit(chat_id, msg_id, text):
+            await asyncio.sleep(.01)
+            texts[msg_id] = text
+        def expire(chat_id, msg_id, delay):
+            expired.append(msg_id)
+        notices = Notices(window=1, delay=2)
+        notices.start(send, edit, expire)
+        for n in range(10):
+            notices.add(-1, 2, "sender %d" % n, [link(n)])
+            await asyncio.sleep(.002)
+        while notices._bursts[-1, 2].task is not None:
+            await asyncio.sleep(.01)
+        assert notices.sent == 1
+        assert notices.edited < 9
+        assert notices.coalesced == 9
+        assert all("sender %d" % n in texts[1] for n in range(10))
+        assert set(expired) == {1}
+    asyncio.run(run())
@@ -0,0 +1,36 @@
+import asyncio
+
+import pytest
+
+from massa_army_bot.outbox import Outbox
+
+def test_stop_fails_queued_and_running_sends():
+    async def run():
+        outbox = Outbox(group_rate=1 / 60, group_burst=1)
+        outbox.start()
+        async def hang():
+            await asyncio.Event().wait()
+        running = asyncio.create_task(outbox.send(-1, hang))
+        # held back by the chat's rate limit
+        queued = asyncio.create_task(outbox.send(-1, hang))
+        await asyncio.sleep(.05)
+        await outbox.stop()
+        for task in (running, queued):
+            with pytest.raises(RuntimeError, match="stopped"):
+                await asyncio.wait_for(task, 1)
+    asyncio.run(run())
+
+def test_idle_buckets_are_evicted():
+    async def run():
+        outbox = Outbox(group_rate=1000, evict_interval=0)
+        outbox.start()
+        async def send():
+            ...
+        await asyncio.gather(*(outbox.send(-n, send)
+                               for n in range(1, 101)))
+        await asyncio.sleep(.05)
+        # refilled by now, dropped on the next pass
+        await outbox.send(-1000, send)
+        assert set(outbox._buckets) <= {-1000}
+        await outbox.stop()
+    asyncio.run(run())
@@ -0,0 +1,110 @@
+import asyncio
+import time
+
+from massa_army_bot.db import Database
+from massa_army_bot.migrations import migrate
+from massa_army_bot.scheduler import DeletionScheduler
+
+tick = .05
+
+def with_db(tmp_path, test):
+    async def run():
+        db = Database(tmp_path / "db.sqlite3")
+        await db.open()
+        try:
+            await migrate(db)
+            await test(db)
+        finally:
+            await db.close()
+    asyncio.run(run())
+
+async def pending(db):
+    return sorted(await db.fetchall(
+        "SELECT chat_id, msg_id FROM pending_deletions"))
+
+def test_overdue_deletions_wait_until_ready(tmp_path):
+    async def test(db):
+        await db.execute("INSERT INTO pending_deletions VALUES (-1, 1, ?)",
+                         (time.time() - 60,))
+        deleted = []
+        async def delete(chat_id, msg_ids):
+            deleted.append((chat_id, msg_ids))
+        ready = asyncio.Event()
+        deletions = DeletionScheduler(db, tick=tick)
+        await deletions.start(delete, ready=ready)
+        await asyncio.sleep(5 * tick)
+        assert deleted == []
+        ready.set()
+        await asyncio.sleep(5 * tick)
+        await deletions.stop()
+        assert deleted == [(-1, [1])]
+        assert await pending(db) == []
+    with_db(tmp_path, test)
+
+def test_failed_deletions_are_retried(tmp_path):
+    async def test(db):
+        calls = []
+        async def delete(chat_id, msg_ids):
+            calls.append(msg_ids)
+            if len(calls) < 3:
+                raise ConnectionError("not connected")
+        deletions = DeletionScheduler(db, tick=tick, retry_delay=5 * tick,
+                                      max_attempts=5)
+        await deletions.start(delete)
+        deletions.schedule(-1, [1, 2], 0)
+        await asyncio.sleep(3 * tick)
+        # still pending after a failure
+        assert calls == [[1, 2]]
+        assert await pending(db) == [(-1, 1), (-1, 2)]
+        await asyncio.sleep(15 * tick)
+        await deletions.stop()
+        assert calls == [[1, 2]] * 3
+        assert await pending(db) == []
+        assert deletions.failed == 0
+    with_db(tmp_path, test)
+
+def test_failed_deletions_are_given_up(tmp_path):
+    async def test(db):
+        async def delete(chat_id, msg_ids):
+            raise PermissionError("can't delete")
+        deletions = DeletionScheduler(db, tick=tick, retry_delay=tick,
+                                      max_attempts=2)
+        await deletions.start(delete)
+        deletions.schedule(-1, [1], 0)
+        await asyncio.sleep(10 * tick)
+        await deletions.stop()
+        assert deletions.failed == 1
+        assert await pending(db) == []
+    with_db(tmp_path, test)
+
+def test_rescheduling_keeps_the_latest_deadline(tmp_path):
+    async def test(db):
+        deleted = []
+        async def delete(chat_id, msg_ids):
+            deleted.extend(msg_ids)
+        deletions = DeletionScheduler(db, tick=tick)
+        await deletions.start(delete)
+        deletions.schedule(-1, [1], 2 * tick)
+        # pushed back, as a notice is on every edit
+        deletions.schedule(-1, [1], 10 * tick)
+        await asyncio.sleep(5 * tick)
+        assert deleted == []
+        await asyncio.sleep(10 * tick)
+        await deletions.stop()
+        assert deleted == [1]
+    with_db(tmp_path, test)
+
+def test_reload_keeps_the_latest_deadline(tmp_path):
+    async def test(db):
+        async def delete(chat_id, msg_ids):
+            ...
+        deletions = DeletionScheduler(db, tick=tick)
+        await deletions.start(delete, ready=asyncio.Event())
+        deletions.schedule(-1, [1], 60)
+        deletions.schedule(-1, [1], 120)
+        await deletions.stop()
+        # one row per message, whatever order start() reads them in
+        deadline, = await db.fetchone(
+            "SELECT deadline FROM pending_deletions")
+        assert deadline > time.time() + 100
+    with_db(tmp_path, test)
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+from massa_army_bot.db import Database
+from massa_army_bot.db import TwPostsIndex
+from massa_army_bot.db import TwPostsWriter
+from massa_army_bot.dedup import WorkItem
+from massa_army_bot.links import TwLink
+from massa_army_bot.maintenance import Maintenance
+from massa_army_bot.migrations import migrate
+from massa_army_bot.workers import Workers
+
+chat = -1001234567890
+
+def item(msg_id, post_id=None, skip_repost=True):
+    post_id = msg_id if post_id is None else post_id
+    url = "https://x.com/a/status/%d" % post_id
+    work = WorkItem(url, [], False, [TwLink("a", post_id, 0, len(url), url)],
+                    "bench_bot", skip_repost=skip_repost)
+    work.title = "Raid"
+    work.raid_topic = work.topic_id = 2
+    work.chat_id = chat
+    work.msg_id = work.date = msg_id
+    work.sender_id = 10
+    work.url = "https://t.me/c/1234567890/%d" % msg_id
+    return work
+
+def test_dead_worker_fails_its_items_and_restarts(tmp_path):
+    async def run():
+        path = tmp_path / "db.sqlite3"
+        db = Database(path)
+        await db.open()
+        await migrate(db)
+        await db.close()
+        workers = Workers(path, count=1)
+        await workers.start()
+        try:
+            assert await workers.submit(item(1)) == []
+            workers._processes[0].kill()
+            with pytest.raises(RuntimeError, match="exited"):
+                await asyncio.wait_for(workers.submit(item(2)), 10)
+            assert workers.restarts == 1
+            # the new worker takes the shard's items
+            assert await asyncio.wait_for(workers.submit(item(3)), 30) == []
+            assert not workers._pending
+        finally:
+            await workers.stop()
+    asyncio.run(run())
+
+def test_pruned_posts_are_forgotten_by_the_workers(tmp_path):
+    async def run():
+        path = tmp_path / "db.sqlite3"
+        db = Database(path)
+        await db.open()
+        await migrate(db)
+        workers = Workers(path, count=1)
+        maintenance = Maintenance(db, TwPostsIndex(db, TwPostsWriter(db)),
+                                  tmp_path / "archive.sqlite3")
+        maintenance.on_prune.append(workers.forget)
+        await workers.start()
+        try:
+            await maintenance.start()
+            assert await workers.submit(item(1)) == []
+            # a duplicate, the row is in the worker's index now
+            actions = await workers.submit(item(2, 1, skip_repost=False))
+            assert [action for action, _ in actions] == ["notice"]
+            # posted in 1970, long past the retention
+            await maintenance.prune()
+            assert maintenance.archived == 1
+            assert await workers.submit(item(3, 1, skip_repost=False)) == []
+        finally:
+            await workers.stop()
+            await maintenance.stop()
+            await db.close()
+    asyncio.run(run())